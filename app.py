@@ -1,17 +1,22 @@
 from flask import (send_file, Flask, render_template, request,
-                   redirect, url_for, flash, jsonify, abort)
-import io, os
+                   redirect, url_for, flash, jsonify, abort, g, Response)
+import hmac, io, os, time
 from werkzeug.utils import secure_filename
 from flask_login import LoginManager, login_required, current_user
 from functools import wraps
 
+import metrics
+import retention
+import stats
 from database import init_db, get_db
 from models import User
 from auth import auth as auth_blueprint
-from detector.preprocess import clean_commands
-from detector.sequence_builder import build_sequences
-from detector.profiler import train_user, get_profile_stats
-from detector.detector import detect
+from detector.preprocess import iter_clean_commands, read_history
+from detector.sequence_builder import iter_windows, NGRAM_ORDER
+from detector.profiler import (train_user_stream, learn_sequences, write_lock,
+                               get_profile_stats, get_top_sequences)
+from detector.detector import detect_iter
+from detector import profile_cache
 
 # load .env
 _env_path = os.path.join(os.path.dirname(__file__), ".env")
@@ -27,8 +32,12 @@ app = Flask(__name__)
 app.secret_key = "csids-secret-key"
 UPLOAD_FOLDER      = "uploads"
 ALLOWED_EXTENSIONS = {"txt", "log", "history"}
+ALERT_COMMIT_EVERY = 500
+ALERT_SHOW_LIMIT   = 1000   # alerts listed on the results page
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 init_db()
+# roll up and expire old live_log rows in the background
+retention.start()
 
 # Flask-Login
 login_manager = LoginManager(app)
@@ -37,6 +46,27 @@ login_manager.login_message          = "Please log in to access this page."
 login_manager.login_message_category = "error"
 app.register_blueprint(auth_blueprint)
 
+HTTP_REQUESTS = metrics.counter(
+    "csids_http_requests_total", "HTTP requests by endpoint and status.")
+HTTP_SECONDS  = metrics.histogram(
+    "csids_http_request_seconds", "HTTP request latency by endpoint.")
+
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        endpoint = request.endpoint or "unmatched"
+        HTTP_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method,
+                          status=response.status_code)
+    return response
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -74,6 +104,48 @@ def is_text_file(filepath):
         return False
 
 
+def history_sequences(path):
+    """
+    Stream an uploaded history through clean → sliding window. Windows
+    are tuples of commands; only alerts and profile rows become text.
+    """
+    lines    = metrics.timed_iter(read_history(path), "upload_parse")
+    commands = metrics.timed_iter(iter_clean_commands(lines), "clean_commands")
+    return metrics.timed_iter(iter_windows(commands), "build_sequences")
+
+
+def store_alert_stream(user, stream):
+    """
+    Insert alerts as the detector yields them. Returns the first
+    ALERT_SHOW_LIMIT of them for display and how many there were; the
+    full set is in the alerts table.
+    """
+    alerts = []
+    count  = 0
+    conn   = get_db()
+    cur    = conn.cursor()
+    # detection is timed as a nested stage, so this is the writes only
+    with metrics.STAGE_SECONDS.time(stage="alert_insert"):
+        for a in metrics.timed_iter(stream, "detect"):
+            cur.execute(
+                "INSERT INTO alerts "
+                "(user,sequence,reason,risk_score,risky_cmds) "
+                "VALUES (?,?,?,?,?)",
+                (user, a["sequence"], a["reason"],
+                 a["risk_score"], ",".join(a["risky"]))
+            )
+            count += 1
+            if count <= ALERT_SHOW_LIMIT:
+                alerts.append(a)
+            # don't hold the write lock for the whole file
+            if count % ALERT_COMMIT_EVERY == 0:
+                conn.commit()
+        conn.commit()
+    conn.close()
+    metrics.ALERTS.inc(count, user=user)
+    return alerts, count
+
+
 # ═══════════════════════════════════════════
 #  ADMIN ROUTES
 # ═══════════════════════════════════════════
@@ -83,36 +155,8 @@ def is_text_file(filepath):
 def dashboard():
     conn = get_db()
     cur  = conn.cursor()
-    cur.execute("SELECT COUNT(DISTINCT user) FROM user_sequences")
-    total_users = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM alerts")
-    total_alerts = cur.fetchone()[0]
-    cur.execute(
-        "SELECT COUNT(*) FROM alerts "
-        "WHERE timestamp > datetime('now', '-1 day')"
-    )
-    alerts_24h = cur.fetchone()[0]
-    cur.execute(
-        "SELECT user, COUNT(*) as cnt FROM alerts "
-        "GROUP BY user ORDER BY cnt DESC LIMIT 5"
-    )
-    top_users = cur.fetchall()
     cur.execute("SELECT * FROM alerts ORDER BY timestamp DESC LIMIT 8")
     recent = cur.fetchall()
-    cur.execute(
-        "SELECT strftime('%H', timestamp) as hour, COUNT(*) as cnt "
-        "FROM alerts GROUP BY hour ORDER BY hour"
-    )
-    hourly_raw = cur.fetchall()
-    cur.execute("""
-        SELECT
-            CASE WHEN risk_score>=6 THEN 'High'
-                 WHEN risk_score>=3 THEN 'Medium'
-                 ELSE 'Low' END as level,
-            COUNT(*) as cnt
-        FROM alerts GROUP BY level
-    """)
-    risk_raw = cur.fetchall()
     cur.execute(
         "SELECT id, username, role, email, created_at "
         "FROM auth_users ORDER BY created_at DESC"
@@ -120,16 +164,10 @@ def dashboard():
     all_auth_users = cur.fetchall()
     conn.close()
 
-    hourly = [0] * 24
-    for row in hourly_raw:
-        hourly[int(row["hour"])] = row["cnt"]
-    risk_dist = {r["level"]: r["cnt"] for r in risk_raw}
-
+    # counters kept up to date on every alert insert/delete
     return render_template("dashboard.html",
-        total_users=total_users, total_alerts=total_alerts,
-        alerts_24h=alerts_24h, top_users=top_users,
-        recent_alerts=recent, hourly=hourly,
-        risk_dist=risk_dist, all_auth_users=all_auth_users)
+        recent_alerts=recent, all_auth_users=all_auth_users,
+        **stats.dashboard_stats())
 
 
 @app.route("/admin/send-alert", methods=["POST"])
@@ -172,17 +210,17 @@ def admin_user_detail(username):
         (username,)
     )
     commands = cur.fetchall()
-    cur.execute(
-        "SELECT sequence, frequency FROM user_sequences "
-        "WHERE user=? ORDER BY frequency DESC LIMIT 50",
-        (username,)
-    )
-    sequences = cur.fetchall()
     conn.close()
+    # older commands may only survive as rollups
+    activity = retention.daily_activity(username,
+                                        request.args.get("days", 30, type=int))
+    hourly   = retention.hourly_activity(username,
+                                         request.args.get("hours", 48, type=int))
+    sequences = get_top_sequences(username, limit=50)
     stats = get_profile_stats(username)
     return render_template("admin_user_detail.html",
-        username=username, alerts=alerts,
-        commands=commands, sequences=sequences, stats=stats)
+        username=username, alerts=alerts, commands=commands,
+        activity=activity, hourly=hourly, sequences=sequences, stats=stats)
 
 
 @app.route("/admin/mark-safe/<int:alert_id>", methods=["POST"])
@@ -190,6 +228,8 @@ def admin_user_detail(username):
 def mark_safe(alert_id):
     conn = get_db()
     cur  = conn.cursor()
+    # the alert, the profile and its aggregates change as one
+    write_lock(cur)
     cur.execute("SELECT * FROM alerts WHERE id=?", (alert_id,))
     alert = cur.fetchone()
     if not alert:
@@ -204,18 +244,14 @@ def mark_safe(alert_id):
     """, (alert['user'], alert['sequence'], current_user.username))
 
     # add to user profile with high frequency so it learns it
-    cur.execute("""
-        INSERT INTO user_sequences (user, sequence, frequency)
-        VALUES (?, ?, 5)
-        ON CONFLICT(user, sequence)
-        DO UPDATE SET frequency = frequency + 5
-    """, (alert['user'], alert['sequence']))
+    learn_sequences(cur, alert['user'], {alert['sequence']: 5})
 
     # delete the alert
     cur.execute("DELETE FROM alerts WHERE id=?", (alert_id,))
 
     conn.commit()
     conn.close()
+    profile_cache.update(alert['user'], {alert['sequence']: 5})
     flash("✅ Marked as safe. System will not alert on this again.", "success")
     return redirect(url_for("alerts_page"))
 
@@ -245,38 +281,24 @@ def analyze():
             os.remove(path)
             flash("File must be plain text.", "error")
             return redirect(url_for("analyze"))
-        with open(path, errors="replace") as f:
-            commands = f.readlines()
-        cleaned   = clean_commands(commands)
-        sequences = build_sequences(cleaned)
+        sequences = history_sequences(path)
         if mode == "train":
-            count = train_user(user, sequences)
-            flash(f"Profile trained for '{user}' — {count} sequences stored.",
-                  "success")
+            with metrics.STAGE_SECONDS.time(stage="train"):
+                learned = train_user_stream(user, sequences)
+            flash(f"Profile trained for '{user}' — {learned.total} sequences "
+                  f"learned ({learned.distinct} distinct).", "success")
             return redirect(url_for("analyze"))
-        alerts, error = detect(user, sequences)
+        stream, error = detect_iter(user, sequences)
         if error:
             flash(error, "error")
             return redirect(url_for("analyze"))
-        if alerts:
-            conn = get_db()
-            cur  = conn.cursor()
-            for a in alerts:
-                cur.execute(
-                    "INSERT INTO alerts "
-                    "(user,sequence,reason,risk_score,risky_cmds) "
-                    "VALUES (?,?,?,?,?)",
-                    (user, a["sequence"], a["reason"],
-                     a["risk_score"], ",".join(a["risky"]))
-                )
-            conn.commit()
-            conn.close()
-            if notify and email:
-                from notifier import send_alert_email
-                send_alert_email(email, user, alerts)
+        alerts, count = store_alert_stream(user, stream)
+        if alerts and notify and email:
+            from notifier import send_alert_email
+            send_alert_email(email, user, alerts)
         return render_template("results.html",
-                               alerts=alerts, user=user,
-                               total=len(sequences))
+                               alerts=alerts, alert_count=count, user=user,
+                               total=stream.total)
     return render_template("analyze.html")
 
 
@@ -315,7 +337,8 @@ def settings():
     return render_template("settings.html",
         smtp_host=smtp_host,
         smtp_port=smtp_port,
-        smtp_user=smtp_user)
+        smtp_user=smtp_user,
+        ngram_order=NGRAM_ORDER)
 
 
 @app.route("/settings/save", methods=["POST"])
@@ -403,35 +426,15 @@ def user_dashboard():
     username = current_user.username
     conn     = get_db()
     cur      = conn.cursor()
-    cur.execute(
-        "SELECT COUNT(*) FROM alerts WHERE user=?", (username,)
-    )
-    total_alerts = cur.fetchone()[0]
-    cur.execute(
-        "SELECT COUNT(*) FROM alerts "
-        "WHERE user=? AND timestamp > datetime('now','-1 day')",
-        (username,)
-    )
-    alerts_24h = cur.fetchone()[0]
     cur.execute(
         "SELECT * FROM alerts WHERE user=? "
         "ORDER BY timestamp DESC LIMIT 8",
         (username,)
     )
     recent = cur.fetchall()
-    cur.execute("""
-        SELECT
-            CASE WHEN risk_score>=6 THEN 'High'
-                 WHEN risk_score>=3 THEN 'Medium'
-                 ELSE 'Low' END as level,
-            COUNT(*) as cnt
-        FROM alerts WHERE user=? GROUP BY level
-    """, (username,))
-    risk_dist = {r["level"]: r["cnt"] for r in cur.fetchall()}
     conn.close()
     return render_template("user_dashboard.html",
-        total_alerts=total_alerts, alerts_24h=alerts_24h,
-        recent_alerts=recent, risk_dist=risk_dist)
+        recent_alerts=recent, **stats.user_stats(username))
 
 
 @app.route("/user/upload", methods=["GET", "POST"])
@@ -457,37 +460,24 @@ def user_upload():
             os.remove(path)
             flash("File must be plain text.", "error")
             return redirect(url_for("user_upload"))
-        with open(path, errors="replace") as f:
-            commands = f.readlines()
-        cleaned   = clean_commands(commands)
-        sequences = build_sequences(cleaned)
+        sequences = history_sequences(path)
         if mode == "train":
-            count = train_user(username, sequences)
-            flash(f"Profile trained — {count} sequences stored.", "success")
+            with metrics.STAGE_SECONDS.time(stage="train"):
+                learned = train_user_stream(username, sequences)
+            flash(f"Profile trained — {learned.total} sequences learned "
+                  f"({learned.distinct} distinct).", "success")
             return redirect(url_for("user_upload"))
-        alerts, error = detect(username, sequences)
+        stream, error = detect_iter(username, sequences)
         if error:
             flash(error, "error")
             return redirect(url_for("user_upload"))
-        if alerts:
-            conn = get_db()
-            cur  = conn.cursor()
-            for a in alerts:
-                cur.execute(
-                    "INSERT INTO alerts "
-                    "(user,sequence,reason,risk_score,risky_cmds) "
-                    "VALUES (?,?,?,?,?)",
-                    (username, a["sequence"], a["reason"],
-                     a["risk_score"], ",".join(a["risky"]))
-                )
-            conn.commit()
-            conn.close()
-            if notify and current_user.email:
-                from notifier import send_alert_email
-                send_alert_email(current_user.email, username, alerts)
+        alerts, count = store_alert_stream(username, stream)
+        if alerts and notify and current_user.email:
+            from notifier import send_alert_email
+            send_alert_email(current_user.email, username, alerts)
         return render_template("results.html",
-                               alerts=alerts, user=username,
-                               total=len(sequences))
+                               alerts=alerts, alert_count=count,
+                               user=username, total=stream.total)
     return render_template("user_upload.html")
 
 
@@ -556,6 +546,8 @@ def user_mark_safe(alert_id):
         return redirect(url_for("alerts_page"))
     conn = get_db()
     cur  = conn.cursor()
+    # the alert, the profile and its aggregates change as one
+    write_lock(cur)
     cur.execute(
         "SELECT * FROM alerts WHERE id=? AND user=?",
         (alert_id, current_user.username)
@@ -573,18 +565,14 @@ def user_mark_safe(alert_id):
     """, (current_user.username, alert['sequence'], current_user.username))
 
     # add to profile with high frequency
-    cur.execute("""
-        INSERT INTO user_sequences (user, sequence, frequency)
-        VALUES (?, ?, 5)
-        ON CONFLICT(user, sequence)
-        DO UPDATE SET frequency = frequency + 5
-    """, (current_user.username, alert['sequence']))
+    learn_sequences(cur, current_user.username, {alert['sequence']: 5})
 
     # delete the alert
     cur.execute("DELETE FROM alerts WHERE id=?", (alert_id,))
 
     conn.commit()
     conn.close()
+    profile_cache.update(current_user.username, {alert['sequence']: 5})
     flash("✅ Marked as safe. System will not alert on this again.", "success")
     return redirect(url_for("user_alerts"))
 
@@ -602,21 +590,23 @@ def api_live_log():
         user = current_user.username
     conn = get_db()
     cur  = conn.cursor()
-    if user:
-        cur.execute(
-            "SELECT id,user,command,risk_score,flagged,timestamp "
-            "FROM live_log WHERE id>? AND user=? "
-            "ORDER BY id ASC LIMIT 100",
-            (since_id, user)
-        )
-    else:
-        cur.execute(
-            "SELECT id,user,command,risk_score,flagged,timestamp "
-            "FROM live_log WHERE id>? ORDER BY id ASC LIMIT 100",
-            (since_id,)
-        )
+    with metrics.STAGE_SECONDS.time(stage="live_log_poll"):
+        if user:
+            cur.execute(
+                "SELECT id,user,command,risk_score,flagged,timestamp "
+                "FROM live_log WHERE id>? AND user=? "
+                "ORDER BY id ASC LIMIT 100",
+                (since_id, user)
+            )
+        else:
+            cur.execute(
+                "SELECT id,user,command,risk_score,flagged,timestamp "
+                "FROM live_log WHERE id>? ORDER BY id ASC LIMIT 100",
+                (since_id,)
+            )
+        found = cur.fetchall()
     rows = []
-    for r in cur.fetchall():
+    for r in found:
         rows.append({
             "id":         r[0],
             "user":       r[1],
@@ -629,6 +619,23 @@ def api_live_log():
     return jsonify(rows)
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Prometheus scrape target. The output names every user, so it needs
+    an admin session or, for scrapers, the CSIDS_METRICS_TOKEN bearer
+    token.
+    """
+    token   = os.environ.get("CSIDS_METRICS_TOKEN")
+    scraper = token and hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(),
+        f"Bearer {token}".encode())
+    admin   = current_user.is_authenticated and current_user.is_admin
+    if not (scraper or admin):
+        abort(403)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route("/api/recent-alerts")
 @login_required
 def api_recent_alerts():
@@ -0,0 +1,214 @@
+"""
+CSIDS batch processor — train or scan many history files at once.
+
+    python batch.py train  histories/            # one file per user
+    python batch.py detect manifest.txt -j 8
+
+A directory is read as one history file per user, named after the file
+("alice.txt", "alice.bash_history" → alice). A manifest lists
+"user path" pairs, one per line, # for comments.
+
+Parsing, windowing and scoring run in a pool of worker processes.
+Only this (parent) process writes to SQLite, committing in batches, so
+workers never contend for the write lock. It commits before waiting
+for a worker, so the lock is never held while nothing is written.
+"""
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool, TimeoutError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database                  import init_db, get_db
+from detector.preprocess       import iter_clean_commands, read_history
+from detector.sequence_builder import iter_windows, count_sequences
+from detector.profiler         import learn_sequences
+from detector.detector         import detect_iter
+
+# rows (profile upserts or alerts) written per transaction
+COMMIT_ROWS = 5000
+
+
+def find_jobs(source):
+    """Return [(user, path)] from a directory or a manifest file."""
+    if os.path.isdir(source):
+        jobs = []
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.isfile(path) and not name.startswith("."):
+                jobs.append((name.split(".")[0] or name, path))
+        return jobs
+
+    base = os.path.dirname(os.path.abspath(source))
+    jobs = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            user, path = line.split(None, 1)
+            jobs.append((user, os.path.join(base, os.path.expanduser(path))))
+    return jobs
+
+
+def _counted(path, counter):
+    for line in read_history(path):
+        counter[0] += 1
+        yield line
+
+
+def process_file(job):
+    """
+    Worker: read and window one history file. For training returns the
+    {sequence: count} delta, for detection the alerts.
+    """
+    mode, user, path = job
+    start = time.perf_counter()
+    lines = [0]
+    try:
+        sequences = iter_windows(iter_clean_commands(_counted(path, lines)))
+        if mode == "train":
+            payload = count_sequences(sequences)
+            windows = sum(payload.values())
+        else:
+            stream, error = detect_iter(user, sequences)
+            if error:
+                raise ValueError(error)
+            payload = list(stream)
+            windows = stream.total
+        error = None
+    except Exception as e:
+        payload, windows, error = None, 0, str(e)
+    return {
+        "user":    user,
+        "path":    path,
+        "lines":   lines[0],
+        "windows": windows,
+        "payload": payload,
+        "error":   error,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _results(results, idle):
+    """Yield from a pool's result iterator, calling idle() before waiting."""
+    while True:
+        try:
+            try:
+                r = results.next(timeout=0)
+            except TimeoutError:
+                idle()
+                r = results.next()
+        except StopIteration:
+            return
+        yield r
+
+
+class Writer:
+    """The single SQLite writer: buffers rows and commits in batches."""
+
+    def __init__(self, commit_rows=COMMIT_ROWS):
+        self.conn        = get_db()
+        self.cur         = self.conn.cursor()
+        self.commit_rows = commit_rows
+        self.pending     = 0
+        self.commits     = 0
+
+    def train(self, user, counts):
+        # at most commit_rows upserts per transaction, even for one
+        # big file, so the write lock is released between them
+        items = list(counts.items())
+        pos   = 0
+        while pos < len(items):
+            chunk = items[pos:pos + self.commit_rows - self.pending]
+            learn_sequences(self.cur, user, dict(chunk))
+            pos  += len(chunk)
+            self._written(len(chunk))
+
+    def alerts(self, user, alerts):
+        self.cur.executemany(
+            "INSERT INTO alerts "
+            "(user,sequence,reason,risk_score,risky_cmds) "
+            "VALUES (?,?,?,?,?)",
+            [(user, a["sequence"], a["reason"],
+              a["risk_score"], ",".join(a["risky"])) for a in alerts]
+        )
+        self._written(len(alerts))
+
+    def _written(self, rows):
+        self.pending += rows
+        if self.pending >= self.commit_rows:
+            self.commit()
+
+    def commit(self):
+        if self.pending:
+            self.conn.commit()
+            self.commits += 1
+            self.pending  = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+
+def run(mode, jobs, workers=None, commit_rows=COMMIT_ROWS):
+    """Process every (user, path) job; returns the per-file results."""
+    init_db()
+    writer  = Writer(commit_rows)
+    results = []
+    start   = time.perf_counter()
+
+    print(f"[BATCH] {mode}: {len(jobs)} files, "
+          f"{workers or os.cpu_count()} workers")
+    out_col = "distinct" if mode == "train" else "alerts"
+    print(f"{'user':<16} {'lines':>9} {'windows':>9} {out_col:>9} "
+          f"{'secs':>7} {'lines/s':>10}  file")
+
+    with Pool(workers) as pool:
+        tasks = [(mode, user, path) for user, path in jobs]
+        for r in _results(pool.imap_unordered(process_file, tasks),
+                          writer.commit):
+            results.append(r)
+            if r["error"]:
+                print(f"[ERROR] {r['user']} {r['path']}: {r['error']}")
+                continue
+            if mode == "train":
+                writer.train(r["user"], r["payload"])
+            else:
+                writer.alerts(r["user"], r["payload"])
+
+            out  = len(r["payload"])
+            rate = r["lines"] / r["seconds"] if r["seconds"] else 0
+            print(f"{r['user']:<16} {r['lines']:>9} {r['windows']:>9} "
+                  f"{out:>9} {r['seconds']:>7.2f} {rate:>10.0f}  {r['path']}")
+            # only the count is kept once written
+            r["payload"] = out
+
+    writer.close()
+    wall  = time.perf_counter() - start
+    lines = sum(r["lines"] for r in results)
+    print(f"[BATCH] {len(results)} files, {lines} lines in {wall:.2f}s "
+          f"({lines / wall if wall else 0:.0f} lines/s), "
+          f"{writer.commits} commits, "
+          f"{sum(1 for r in results if r['error'])} errors")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSIDS Batch Processor")
+    parser.add_argument("mode", choices=["train", "detect"])
+    parser.add_argument("source",
+                        help="directory of per-user histories or a manifest")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: CPU count)")
+    parser.add_argument("--commit-rows", type=int, default=COMMIT_ROWS,
+                        help="rows written per SQLite transaction")
+    args = parser.parse_args()
+
+    jobs = find_jobs(args.source)
+    if not jobs:
+        print(f"[ERROR] No history files found in {args.source}")
+        sys.exit(1)
+    run(args.mode, jobs, args.workers, args.commit_rows)
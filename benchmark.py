@@ -0,0 +1,320 @@
+"""
+CSIDS benchmark — times each stage of the detection pipeline on
+reproducible synthetic histories and prints the results as JSON.
+
+    python benchmark.py --users 4 --lines 100000 --seed 1 -o run.json
+    python benchmark.py --lines 100000 --seed 1 --compare run.json
+
+Histories are generated from normal_history.txt (replayed in chunks so
+command transitions look real) with bursts from suspicious_history.txt
+injected at --attack-rate. The same seed and parameters always give
+the same files. Each user's history is split into a training part and
+a detection part, and these stages are timed:
+
+    clean_commands, build_sequences, train_user, detect, get_risk_score
+
+For each stage the report has items/sec, the process's peak RSS after
+it and the SQLite rows written and statements run. Everything runs
+against a throwaway database, never ids.db.
+
+With --check, each user's detection batch is also cross-checked
+(untimed): the incremental TF-IDF similarity against a full rebuild
+(CSIDS_VERIFY_TFIDF), before and after compacting the profile to half
+its sequences.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+import database
+import detector.detector as detector_mod
+import detector.profiler as profiler_mod
+from detector                  import profile_cache, sparse_engine
+from detector.preprocess       import clean_commands, get_risk_score, read_history
+from detector.sequence_builder import build_sequences
+
+STAGES = ["clean_commands", "build_sequences", "train_user",
+          "detect", "get_risk_score"]
+
+
+# ── synthetic histories ───────────────────────────────────────
+
+def _history_lines(name):
+    with open(os.path.join(ROOT, name), errors="replace") as f:
+        return [l.rstrip("\n") for l in f
+                if l.strip() and not l.startswith("#")]
+
+
+def build_vocab(normal, vocab_size):
+    """
+    Map every normal command to its family of variants, so that the
+    generated histories use exactly `vocab_size` distinct commands.
+    """
+    distinct = list(dict.fromkeys(normal))
+    if vocab_size <= len(distinct):
+        keep = distinct[:vocab_size]
+        return {cmd: [keep[i % vocab_size]] for i, cmd in enumerate(distinct)}
+
+    family = {cmd: [cmd] for cmd in distinct}
+    for i in range(vocab_size - len(distinct)):
+        cmd = distinct[i % len(distinct)]
+        family[cmd].append(f"{cmd} v{len(family[cmd])}")
+    return family
+
+
+def synthetic_history(rng, lines, vocab, attacks, attack_rate):
+    """
+    Yield `lines` history lines: chunks of the normal history replayed
+    from random offsets, each line drawn from its vocabulary family.
+    Each line starts an attack burst with probability `attack_rate`.
+    """
+    normal  = list(vocab)
+    emitted = 0
+    while emitted < lines:
+        start = rng.randrange(len(normal))
+        for cmd in normal[start:start + rng.randint(5, 30)]:
+            if emitted >= lines:
+                return
+            yield rng.choice(vocab[cmd])
+            emitted += 1
+            if rng.random() < attack_rate:
+                first = rng.randrange(len(attacks))
+                for bad in attacks[first:first + rng.randint(3, 8)]:
+                    if emitted >= lines:
+                        return
+                    yield bad
+                    emitted += 1
+
+
+def write_histories(directory, users, lines, vocab_size, attack_rate, seed):
+    """Write one synthetic history per user; returns [(user, path)]."""
+    normal  = _history_lines("normal_history.txt")
+    attacks = _history_lines("suspicious_history.txt")
+    vocab   = build_vocab(normal, vocab_size)
+    # keep replay order: dict preserves the first-seen order of commands
+    vocab   = {cmd: vocab[cmd] for cmd in normal}
+
+    jobs = []
+    for u in range(users):
+        rng  = random.Random(f"{seed}:{u}")
+        user = f"bench{u}"
+        path = os.path.join(directory, f"{user}.txt")
+        with open(path, "w") as f:
+            for line in synthetic_history(rng, lines, vocab, attacks,
+                                          attack_rate):
+                f.write(line + "\n")
+        jobs.append((user, path))
+    return jobs
+
+
+# ── measurement ───────────────────────────────────────────────
+
+_sql = {"rows": 0, "statements": 0}
+
+
+def _count_statement(_):
+    _sql["statements"] += 1
+
+
+class _CountingConnection(database.PooledConnection):
+    """A pooled connection that counts its statements and rows written."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counted = 0
+        self.set_trace_callback(_count_statement)
+
+    def close(self):
+        _sql["rows"] += self.total_changes - self.counted
+        self.counted  = self.total_changes
+        super().close()
+
+
+def use_database(path):
+    """Point every module at a scratch database and count its traffic."""
+    database.close_pool()
+    database.DB_PATH            = path
+    database.CONNECTION_FACTORY = _CountingConnection
+    database.init_db()
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_checks(user, sequences):
+    """
+    Detect `sequences` in verify mode and, with numpy, compare the
+    sparse engine's alerts with the tfidf engine's; compact the
+    profile to half its sequences and do both again. Raises
+    AssertionError on any drift.
+    """
+    sparse = sparse_engine.available()
+    detector_mod.VERIFY_INCREMENTAL = True
+    try:
+        detector_mod.detect(user, sequences, "tfidf")
+        if sparse:
+            _parity(user, sequences)
+        stored    = profiler_mod.get_profile_stats(user)["total_sequences"]
+        compacted = profiler_mod.compact_profile(
+            user, max_sequences=max(stored // 2, 1), horizon_days=0)
+        detector_mod.detect(user, sequences, "tfidf")
+        if sparse:
+            _parity(user, sequences)
+    finally:
+        detector_mod.VERIFY_INCREMENTAL = False
+    return {"verify": "ok",
+            "sparse": "ok" if sparse else "skipped (numpy not installed)",
+            "compacted": [compacted.before, compacted.after],
+            "residual": compacted.residual}
+
+
+def _parity(user, sequences):
+    diffs = sparse_engine.check_parity(user, sequences)
+    assert not diffs, f"{user}: sparse engine differs from tfidf: {diffs[:3]}"
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {name: {"seconds": 0.0, "items": 0,
+                              "rows_written": 0, "statements": 0}
+                       for name in STAGES}
+
+    def run(self, name, items, fn, *args):
+        rows, stmts = _sql["rows"], _sql["statements"]
+        start  = time.perf_counter()
+        result = fn(*args)
+        st     = self.stages[name]
+        st["seconds"]      += time.perf_counter() - start
+        st["items"]        += items(result) if callable(items) else items
+        st["rows_written"] += _sql["rows"] - rows
+        st["statements"]   += _sql["statements"] - stmts
+        st["peak_rss_kb"]   = peak_rss_kb()
+        return result
+
+    def report(self):
+        for st in self.stages.values():
+            st["per_sec"] = round(st["items"] / st["seconds"]) \
+                if st["seconds"] else None
+            st["seconds"] = round(st["seconds"], 4)
+        return self.stages
+
+
+def run_benchmark(users=1, lines=10_000, vocab_size=200, attack_rate=0.01,
+                  seed=42, train_fraction=0.5, engine=None, keep=False,
+                  check=False):
+    workdir = tempfile.mkdtemp(prefix="csids-bench-")
+    try:
+        use_database(os.path.join(workdir, "bench.db"))
+        jobs  = write_histories(workdir, users, lines, vocab_size,
+                                attack_rate, seed)
+        timer = StageTimer()
+        alerts  = 0
+        checks  = {}
+        checked = 0.0
+        start   = time.perf_counter()
+
+        for user, path in jobs:
+            cmds = timer.run("clean_commands", len, clean_commands,
+                             read_history(path))
+            seqs = timer.run("build_sequences", len, build_sequences, cmds)
+            cut  = int(len(seqs) * train_fraction)
+            train, test = seqs[:cut], seqs[cut:]
+
+            timer.run("train_user", len(train),
+                      profiler_mod.train_user, user, train)
+            found, error = timer.run("detect", len(test),
+                                     detector_mod.detect, user, test, engine)
+            if error:
+                raise RuntimeError(error)
+            alerts += len(found)
+            timer.run("get_risk_score", len(test),
+                      lambda s: [get_risk_score(x) for x in s], test)
+
+            if check:
+                began        = time.perf_counter()
+                checks[user] = run_checks(user, test)
+                checked     += time.perf_counter() - began
+
+        wall = time.perf_counter() - start - checked
+        return {
+            "config": {
+                "users": users, "lines": lines, "vocab_size": vocab_size,
+                "attack_rate": attack_rate, "seed": seed,
+                "train_fraction": train_fraction,
+                "engine": engine or detector_mod.DETECT_ENGINE,
+            },
+            "env": {
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+            },
+            "stages":        timer.report(),
+            "alerts":        alerts,
+            "checks":        checks if check else None,
+            "cache":         profile_cache.stats(),
+            "total_seconds": round(wall, 4),
+            "lines_per_sec": round(users * lines / wall) if wall else None,
+            "peak_rss_kb":   peak_rss_kb(),
+            "workdir":       workdir if keep else None,
+        }
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(base, result):
+    """Print per-stage throughput of `result` relative to `base`."""
+    print(f"{'stage':<16} {'base/s':>12} {'now/s':>12} {'ratio':>7}",
+          file=sys.stderr)
+    for name in STAGES:
+        old = base["stages"].get(name, {}).get("per_sec")
+        new = result["stages"][name]["per_sec"]
+        ratio = f"{new / old:.2f}x" if old and new else "-"
+        print(f"{name:<16} {old or '-':>12} {new or '-':>12} {ratio:>7}",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSIDS Benchmark")
+    parser.add_argument("--users",  type=int, default=1)
+    parser.add_argument("--lines",  type=int, default=10_000,
+                        help="history lines per user (1k - 10M)")
+    parser.add_argument("--vocab",  type=int, default=200,
+                        help="distinct commands in the generated histories")
+    parser.add_argument("--attack-rate", type=float, default=0.01,
+                        help="chance per line of injecting an attack burst")
+    parser.add_argument("--seed",   type=int, default=42)
+    parser.add_argument("--train-fraction", type=float, default=0.5)
+    parser.add_argument("--engine", default=None,
+                        help="detection engine (default: CSIDS_ENGINE)")
+    parser.add_argument("-o", "--output", help="write JSON here too")
+    parser.add_argument("--compare", help="earlier JSON result to compare to")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the generated histories and database")
+    parser.add_argument("--check", action="store_true",
+                        help="also cross-check the fast scoring paths (untimed)")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.users, args.lines, args.vocab,
+                           args.attack_rate, args.seed, args.train_fraction,
+                           args.engine, args.keep, args.check)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
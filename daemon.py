@@ -0,0 +1,273 @@
+"""
+CSIDS monitor daemon — watch many users' histories from one process.
+
+    python monitor.py --config users.txt          # "user path" per line
+    python monitor.py --discover                  # /home/*/.bash_history
+
+One asyncio event loop tails every file: each history gets a
+FileWatcher whose inotify descriptor is registered with the loop (or
+a stat() poll when inotify is unavailable), so idle users cost nothing.
+When a file changes, that user's UserMonitor reads and scores the new
+commands on a shared thread pool; its buffered writes are flushed on
+the same pool when due, and for every user on shutdown. A user's
+commands are processed in order, one batch at a time. Different users
+run concurrently and share the profile cache and the pooled SQLite
+connections.
+
+Each user's lag is exported as metrics and printed every
+--status-interval seconds. Lag is the bytes not yet read and the age
+of the oldest unprocessed change.
+"""
+import asyncio
+import glob
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from database import init_db
+from monitor import UserMonitor, IDLE_TIMEOUT
+from watcher import FileWatcher, POLL_INTERVAL
+
+DISCOVER_GLOB     = "/home/*/.bash_history"
+DISCOVER_INTERVAL = 60      # seconds between looks for new accounts
+WORKERS           = 4       # detection threads shared by all users
+
+LAG_SECONDS = metrics.gauge(
+    "csids_monitor_lag_seconds",
+    "Age of the oldest history change not yet processed, per user.")
+LAG_BYTES   = metrics.gauge(
+    "csids_monitor_lag_bytes",
+    "History bytes not yet read, per user.")
+
+
+def read_config(path):
+    """[(user, path)] from a file of "user path" lines (# for comments)."""
+    base    = os.path.dirname(os.path.abspath(path))
+    targets = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            user, history = line.split(None, 1)
+            history = os.path.join(base, os.path.expanduser(history))
+            targets.append((user, history))
+    return targets
+
+
+def discover(pattern=DISCOVER_GLOB):
+    """[(user, path)] for every history matching `pattern`, user = its home dir."""
+    return [(os.path.basename(os.path.dirname(p)), p)
+            for p in sorted(glob.glob(pattern))]
+
+
+class Tail:
+    """One watched history: its UserMonitor, watcher and lag."""
+
+    def __init__(self, user, path):
+        self.user    = user
+        self.path    = os.path.abspath(path)
+        self.session = None
+        self.watcher = None
+        self.wake    = asyncio.Event()
+        self.pending = None     # monotonic time of the oldest unhandled change
+        self.task    = None
+        self.loop    = None
+        self.fd      = None
+        self.poller  = None
+
+    def changed(self):
+        if self.pending is None:
+            self.pending = time.monotonic()
+        self.wake.set()
+
+    def lag(self):
+        seconds = time.monotonic() - self.pending if self.pending else 0.0
+        behind  = 0
+        if self.session is not None:
+            try:
+                behind = max(os.path.getsize(self.path) - self.session.last_pos, 0)
+            except OSError:
+                pass
+        return seconds, behind
+
+    async def run(self, loop, pool):
+        # the file may not exist until the user's first logout
+        while not os.path.exists(self.path):
+            await asyncio.sleep(POLL_INTERVAL * 5)
+        try:
+            self.session = await loop.run_in_executor(
+                pool, UserMonitor, self.user, self.path, True)
+        except Exception as e:
+            print(f"[ERROR] {self.user}: cannot monitor {self.path}: {e}")
+            return
+
+        self.loop    = loop
+        self.watcher = FileWatcher(self.path)
+        self.fd      = self.watcher.fileno()
+        self.poller  = None
+        if self.fd is not None:
+            loop.add_reader(self.fd, self._on_events)
+        else:
+            self.poller = asyncio.ensure_future(self._poll())
+        print(f"[DAEMON] watching {self.user:<16} {self.path} "
+              f"({self.watcher.mode})")
+
+        # commands written since the last run are processed at once
+        self.changed()
+        try:
+            while True:
+                # pending writes cut the wait short so they get flushed
+                due = self.session.flush_in()
+                try:
+                    await asyncio.wait_for(
+                        self.wake.wait(),
+                        IDLE_TIMEOUT if due is None else min(due, IDLE_TIMEOUT))
+                except asyncio.TimeoutError:
+                    pass
+                self.wake.clear()
+                started = self.pending
+                try:
+                    await loop.run_in_executor(pool, self.session.poll)
+                except Exception as e:
+                    print(f"[ERROR] {self.user}: {e}")
+                    await asyncio.sleep(2)
+                if self.pending == started:
+                    self.pending = None
+                elif started is not None:
+                    # changes arrived while processing: their lag
+                    # starts when processing of the previous batch ended
+                    self.pending = time.monotonic()
+        finally:
+            self._stop_watching()
+
+    def _stop_watching(self):
+        if self.poller is not None:
+            self.poller.cancel()
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+        self.watcher.close()
+
+    def _on_events(self):
+        try:
+            relevant = self.watcher.read_events()
+        except OSError as e:
+            print(f"[ERROR] {self.user}: {e}")
+            relevant = True
+        if self.watcher.fileno() is None:
+            # the directory went away: the watcher fell back to polling
+            self.loop.remove_reader(self.fd)
+            self.fd     = None
+            self.poller = asyncio.ensure_future(self._poll())
+        if relevant:
+            self.changed()
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.watcher.poll_interval)
+            if self.watcher.read_events():
+                self.changed()
+
+
+class Daemon:
+    def __init__(self, targets, workers=WORKERS, discover_glob=None,
+                 status_interval=60, metrics_file=None):
+        self.targets         = list(targets)
+        self.workers         = workers
+        self.discover_glob   = discover_glob
+        self.status_interval = status_interval
+        self.metrics_file    = metrics_file
+        self.tails           = {}
+
+    def add(self, loop, pool, user, path):
+        if user in self.tails:
+            return
+        tail = self.tails[user] = Tail(user, path)
+        tail.task = asyncio.ensure_future(tail.run(loop, pool))
+
+    def _discover(self, loop, pool):
+        for user, path in discover(self.discover_glob):
+            self.add(loop, pool, user, path)
+
+    def _write_metrics(self):
+        if self.metrics_file:
+            metrics.write_file(self.metrics_file)
+
+    def status(self):
+        print(f"[DAEMON] {'user':<16} {'mode':<8} {'commands':>9} "
+              f"{'lag s':>7} {'lag bytes':>10}")
+        for user, tail in sorted(self.tails.items()):
+            seconds, behind = tail.lag()
+            mode     = tail.watcher.mode if tail.watcher else "waiting"
+            commands = tail.session.commands if tail.session else 0
+            print(f"[DAEMON] {user:<16} {mode:<8} {commands:>9} "
+                  f"{seconds:>7.2f} {behind:>10}")
+
+    def _collect(self):
+        for user, tail in self.tails.items():
+            seconds, behind = tail.lag()
+            LAG_SECONDS.set(seconds, user=user)
+            LAG_BYTES.set(behind, user=user)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        metrics.collector(self._collect)
+
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix="csids-detect")
+        for user, path in self.targets:
+            self.add(loop, pool, user, path)
+        print(f"[DAEMON] {len(self.tails)} users, {self.workers} workers")
+
+        # periodic jobs: [interval, next due, action]
+        jobs = [[IDLE_TIMEOUT, 0, self._write_metrics]]
+        if self.discover_glob:
+            jobs.append([DISCOVER_INTERVAL, 0,
+                         lambda: self._discover(loop, pool)])
+        if self.status_interval:
+            jobs.append([self.status_interval, 0, self.status])
+        for job in jobs:
+            job[1] = time.monotonic() + job[0]
+
+        try:
+            while not stop.is_set():
+                # sleep until the next job is due — no fixed tick
+                wait = min(due for _, due, _ in jobs) - time.monotonic()
+                try:
+                    await asyncio.wait_for(stop.wait(), max(wait, 0))
+                except asyncio.TimeoutError:
+                    pass
+                now = time.monotonic()
+                for job in jobs:
+                    if now >= job[1]:
+                        job[2]()
+                        job[1] = now + job[0]
+        finally:
+            for tail in self.tails.values():
+                tail.task.cancel()
+            await asyncio.gather(*(t.task for t in self.tails.values()),
+                                 return_exceptions=True)
+            # let batches still running finish, then write what they left
+            pool.shutdown(wait=True)
+            for tail in self.tails.values():
+                if tail.session is not None:
+                    tail.session.flush()
+            print("\n[CSIDS] Daemon stopped.")
+
+
+def run(targets, workers=WORKERS, discover_glob=None, status_interval=60,
+        metrics_file=None):
+    """Monitor every (user, path) in `targets` (plus discovered ones)."""
+    # every UserMonitor uses tables of the latest schema
+    init_db()
+    targets = list(targets)
+    if discover_glob:
+        targets += [t for t in discover(discover_glob)
+                    if t[0] not in {u for u, _ in targets}]
+    asyncio.run(Daemon(targets, workers, discover_glob, status_interval,
+                       metrics_file).run())
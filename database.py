@@ -1,24 +1,225 @@
 import sqlite3
+import hashlib
 import os
+import threading
+import time
+
+import metrics
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "ids.db")
 
+
+def sequence_hash(text):
+    """Stable signed 64-bit hash used to look up interned sequences."""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+# ── connections ───────────────────────────────────────────────
+#
+# Every module opens the database through get_db(). Connections are
+# pooled per thread: close() hands one back to its thread's idle list
+# instead of closing it, so its page cache and compiled statements
+# (sqlite3's per-connection statement cache) survive from one query to
+# the next. A nested get_db() while another is checked out gets its
+# own connection, so one caller's close() never rolls back another's
+# transaction.
+
+# applied to every new connection
+PRAGMAS = [
+    ("journal_mode", "WAL"),        # readers and the writer don't block each other
+    ("synchronous",  "NORMAL"),     # with WAL: durable at checkpoints, no fsync per commit
+    ("cache_size",   -16000),       # page cache in KiB (16 MB)
+    ("mmap_size",    256 << 20),    # read through a 256 MB memory map
+    ("temp_store",   "MEMORY"),
+]
+
+BUSY_TIMEOUT    = 5.0       # seconds to wait for a lock before "database is locked"
+POOL_SIZE       = 4         # idle connections kept per thread
+STATEMENT_CACHE = 256       # compiled statements kept per connection
+
+_local     = threading.local()
+_abandoned = []
+
+
+class PooledConnection(metrics.TimedConnection):
+    """A connection that returns to its thread's pool on close()."""
+
+    def close(self):
+        idle = _idle()
+        if any(c is self for c in idle):
+            return
+        if self.in_transaction:
+            # same as closing: uncommitted work is discarded
+            self.rollback()
+        if self.db_path == DB_PATH and len(idle) < POOL_SIZE:
+            idle.append(self)
+        else:
+            super().close()
+
+    def release(self):
+        """Really close the connection."""
+        super().close()
+
+
+# class of the connections get_db() opens (benchmark.py counts through it)
+CONNECTION_FACTORY = PooledConnection
+
+
+def _idle():
+    if getattr(_local, "pid", None) != os.getpid():
+        # forked child: the parent's connections must not be used, or
+        # closed, here — just drop them
+        _abandoned.extend(getattr(_local, "idle", ()))
+        _local.idle = []
+        _local.pid  = os.getpid()
+    return _local.idle
+
+
+def connect(path=None, factory=None):
+    """Open a new, tuned connection to `path` (default DB_PATH)."""
+    path = path or DB_PATH
+    conn = sqlite3.connect(path, factory=factory or CONNECTION_FACTORY,
+                           timeout=BUSY_TIMEOUT,
+                           cached_statements=STATEMENT_CACHE)
+    conn.db_path = path
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    """A pooled connection to DB_PATH; close() returns it to the pool."""
+    idle = _idle()
+    while idle:
+        conn = idle.pop()
+        if conn.db_path == DB_PATH:
+            break
+        conn.release()
+    else:
+        conn = connect()
     conn.row_factory = sqlite3.Row
     return conn
 
+
+def close_pool():
+    """Really close this thread's idle connections."""
+    idle = _idle()
+    while idle:
+        idle.pop().release()
+
+
+# ── schema migrations ─────────────────────────────────────────
+#
+# The schema version is kept in SQLite's PRAGMA user_version. Each
+# MIGRATIONS entry upgrades the database from the version before it;
+# migrate() applies the pending ones in order, each in one transaction
+# with its version bump, so an interrupted upgrade resumes at the step
+# that failed. Version 1 is the schema init_db() used to create ad hoc:
+# on a database from before versioning it only creates what is missing
+# and converts the legacy tables.
+
 def init_db():
-    conn = get_db()
-    cur  = conn.cursor()
+    """Create or upgrade the schema (see migrate())."""
+    return migrate()
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate():
+    """Apply pending MIGRATIONS; returns the resulting schema version."""
+    conn    = get_db()
+    cur     = conn.cursor()
+    version = schema_version(conn)
+    if version > SCHEMA_VERSION:
+        conn.close()
+        raise RuntimeError(
+            f"{DB_PATH} has schema version {version}, newer than this "
+            f"code's {SCHEMA_VERSION} — upgrade CSIDS first")
+
+    # stay quiet while creating a brand-new database
+    fresh  = version == 0 and not _has_table(cur, "alerts")
+    vacuum = False
+    for target, description, upgrade in MIGRATIONS:
+        if target <= version:
+            continue
+        cur.execute("BEGIN IMMEDIATE")
+        # another process may have applied it while we waited for the lock
+        version = schema_version(conn)
+        if target <= version:
+            conn.rollback()
+            continue
+        if not fresh:
+            print(f"[DB] Schema v{version} → v{target}: {description}")
+        try:
+            vacuum |= bool(upgrade(conn))
+            cur.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            conn.close()
+            raise
+        version = target
+
+    if vacuum:
+        # reclaim the space dropped tables and indexes used
+        conn.execute("VACUUM")
+    conn.close()
+    return version
+
+
+def _v1_base_schema(conn):
+    """The schema init_db() created before it was versioned."""
+    cur = conn.cursor()
+    vacuum = False
+
+    # profiles are stored as integers: each distinct sequence text is
+    # interned once in sequence_vocab and shared by every user
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS profile_users (
+            id   INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS sequence_vocab (
+            id   INTEGER PRIMARY KEY,
+            hash INTEGER NOT NULL,
+            text TEXT    NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sequence_vocab_hash
+        ON sequence_vocab(hash)
+    """)
+
+    if _has_column(cur, "user_sequences", "sequence"):
+        _migrate_user_sequences(conn)
+        vacuum = True
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS user_sequences (
-            id        INTEGER PRIMARY KEY AUTOINCREMENT,
-            user      TEXT NOT NULL,
-            sequence  TEXT NOT NULL,
-            frequency INTEGER DEFAULT 1,
-            UNIQUE(user, sequence)
+            user_id     INTEGER NOT NULL,
+            sequence_id INTEGER NOT NULL,
+            frequency   INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (user_id, sequence_id)
+        ) WITHOUT ROWID
+    """)
+
+    # running TF-IDF aggregates per profile — see detector/tfidf.py
+    if _has_column(cur, "profile_stats", "user"):
+        # keyed by name before profile_users existed — rebuilt on demand
+        cur.execute("DROP TABLE profile_stats")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS profile_stats (
+            user_id     INTEGER PRIMARY KEY,
+            total       INTEGER NOT NULL DEFAULT 0,
+            sum_sq      REAL    NOT NULL DEFAULT 0,
+            sum_sq_log  REAL    NOT NULL DEFAULT 0,
+            sum_sq_log2 REAL    NOT NULL DEFAULT 0
         )
     """)
 
@@ -67,5 +268,220 @@ def init_db():
         )
     """)
 
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    return vacuum
+
+
+def _v2_query_indexes(conn):
+    """Indexes for the per-user alert and live-log queries."""
+    cur = conn.cursor()
+
+    # WHERE user=? ORDER BY timestamp DESC, COUNT(*) WHERE user=?
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_alerts_user_timestamp
+        ON alerts(user, timestamp)
+    """)
+    # dashboard: latest alerts, alerts in the last 24h
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_alerts_timestamp
+        ON alerts(timestamp)
+    """)
+    # live feed polling (WHERE id>? AND user=?) and the monitor's
+    # COUNT(*) WHERE user=? on every command
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_live_log_user_id
+        ON live_log(user, id)
+    """)
+
+
+def _v3_profile_compaction(conn):
+    """Per-sequence last-seen time and the residual of pruned sequences."""
+    cur = conn.cursor()
+
+    # unix seconds; rows from before this version count as seen now,
+    # so the horizon for pruning them starts at the upgrade
+    cur.execute("""
+        ALTER TABLE user_sequences
+        ADD COLUMN last_seen INTEGER NOT NULL DEFAULT 0
+    """)
+    cur.execute("UPDATE user_sequences SET last_seen=?", (int(time.time()),))
+
+    # observations of sequences compaction removed, still part of total
+    cur.execute("""
+        ALTER TABLE profile_stats
+        ADD COLUMN residual INTEGER NOT NULL DEFAULT 0
+    """)
+
+
+def _v4_live_log_rollups(conn):
+    """Hourly and daily live_log aggregates kept by retention.py."""
+    cur = conn.cursor()
+    for table, bucket in (("live_log_hourly", "hour"), ("live_log_daily", "day")):
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                user     TEXT    NOT NULL,
+                {bucket:<8} TEXT    NOT NULL,
+                commands INTEGER NOT NULL DEFAULT 0,
+                flagged  INTEGER NOT NULL DEFAULT 0,
+                risky    INTEGER NOT NULL DEFAULT 0,
+                max_risk REAL    NOT NULL DEFAULT 0,
+                sum_risk REAL    NOT NULL DEFAULT 0,
+                PRIMARY KEY (user, {bucket})
+            ) WITHOUT ROWID
+        """)
+
+    # progress markers of background jobs, e.g. the last rolled-up id
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS job_state (
+            name  TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+
+# how alerts are bucketed in alert_stats, over a row `r` of alerts
+ALERT_HOUR  = "COALESCE(CAST(strftime('%H', {r}.timestamp) AS INTEGER), 0)"
+ALERT_LEVEL = ("CASE WHEN {r}.risk_score>=6 THEN 'High' "
+               "WHEN {r}.risk_score>=3 THEN 'Medium' ELSE 'Low' END")
+
+
+def _alert_stats_change(r, sign):
+    """Trigger statement adding `sign` to the bucket of alert row `r`."""
+    return f"""
+        INSERT INTO alert_stats (user, hour, level, alerts)
+        VALUES ({r}.user, {ALERT_HOUR.format(r=r)},
+                {ALERT_LEVEL.format(r=r)}, {sign})
+        ON CONFLICT(user, hour, level) DO UPDATE SET
+            alerts = alerts + excluded.alerts;
+    """
+
+
+def backfill_alert_stats(cur):
+    """Recompute alert_stats from the alerts table."""
+    cur.execute("DELETE FROM alert_stats")
+    cur.execute(f"""
+        INSERT INTO alert_stats (user, hour, level, alerts)
+        SELECT user, {ALERT_HOUR.format(r="alerts")},
+               {ALERT_LEVEL.format(r="alerts")}, COUNT(*)
+        FROM alerts GROUP BY 1, 2, 3
+    """)
+
+
+def _v5_alert_stats(conn):
+    """Alert counts per user, hour of day and risk level, kept by triggers."""
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS alert_stats (
+            user   TEXT    NOT NULL,
+            hour   INTEGER NOT NULL,
+            level  TEXT    NOT NULL,
+            alerts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user, hour, level)
+        ) WITHOUT ROWID
+    """)
+    # every writer (app, monitor, batch, mark-safe) stays in step, in
+    # the same transaction as the alert itself
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS alert_stats_insert
+        AFTER INSERT ON alerts BEGIN {_alert_stats_change("NEW", 1)} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS alert_stats_delete
+        AFTER DELETE ON alerts BEGIN {_alert_stats_change("OLD", -1)} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS alert_stats_update
+        AFTER UPDATE OF user, risk_score, timestamp ON alerts BEGIN
+            {_alert_stats_change("OLD", -1)}
+            {_alert_stats_change("NEW", 1)}
+        END
+    """)
+    backfill_alert_stats(cur)
+
+
+def _v6_read_offsets(conn):
+    """How far the monitor has read each history file (see offsets.py)."""
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS read_offsets (
+            user    TEXT      NOT NULL,
+            path    TEXT      NOT NULL,
+            inode   INTEGER   NOT NULL,
+            size    INTEGER   NOT NULL,
+            offset  INTEGER   NOT NULL,
+            tail    BLOB      NOT NULL,
+            updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user, path)
+        ) WITHOUT ROWID
+    """)
+
+
+MIGRATIONS = [
+    (1, "base schema",                     _v1_base_schema),
+    (2, "indexes for alert and live feed", _v2_query_indexes),
+    (3, "profile compaction bookkeeping",  _v3_profile_compaction),
+    (4, "live_log rollups",                _v4_live_log_rollups),
+    (5, "materialized alert statistics",   _v5_alert_stats),
+    (6, "monitor read offsets",            _v6_read_offsets),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _has_table(cur, table):
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                (table,))
+    return cur.fetchone() is not None
+
+
+def _has_column(cur, table, column):
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(r["name"] == column for r in cur.fetchall())
+
+
+def _migrate_user_sequences(conn):
+    """
+    Convert the old text-keyed user_sequences (user, sequence, frequency)
+    into profile_users + sequence_vocab + integer-keyed user_sequences.
+    """
+    print("[DB] Migrating user_sequences to integer-encoded vocabulary...")
+    conn.create_function("csids_hash", 1, sequence_hash, deterministic=True)
+    cur = conn.cursor()
+
+    cur.execute("ALTER TABLE user_sequences RENAME TO user_sequences_legacy")
+    cur.execute("""
+        CREATE TABLE user_sequences (
+            user_id     INTEGER NOT NULL,
+            sequence_id INTEGER NOT NULL,
+            frequency   INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (user_id, sequence_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        INSERT OR IGNORE INTO profile_users (name)
+        SELECT DISTINCT user FROM user_sequences_legacy
+    """)
+    cur.execute("""
+        INSERT INTO sequence_vocab (hash, text)
+        SELECT csids_hash(l.sequence), l.sequence
+        FROM (SELECT DISTINCT sequence FROM user_sequences_legacy) l
+        WHERE NOT EXISTS (
+            SELECT 1 FROM sequence_vocab v
+            WHERE v.hash = csids_hash(l.sequence) AND v.text = l.sequence
+        )
+    """)
+    cur.execute("""
+        INSERT INTO user_sequences (user_id, sequence_id, frequency)
+        SELECT u.id, v.id, SUM(l.frequency)
+        FROM user_sequences_legacy l
+        JOIN profile_users  u ON u.name = l.user
+        JOIN sequence_vocab v ON v.hash = csids_hash(l.sequence)
+                             AND v.text = l.sequence
+        GROUP BY u.id, v.id
+    """)
+    cur.execute("SELECT COUNT(*) FROM user_sequences")
+    moved = cur.fetchone()[0]
+    cur.execute("DROP TABLE user_sequences_legacy")
+    print(f"[DB] Migrated {moved} profile rows.")
+
+
+if __name__ == "__main__":
+    print(f"[DB] {DB_PATH}: schema version {init_db()}")
@@ -1,8 +1,34 @@
-import sqlite3
 import os
 import math
 
-DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "ids.db")
+from collections import Counter
+from functools import lru_cache
+
+import metrics
+from database import get_db
+from detector import profile_cache, snapshot
+from detector.matcher import Matcher
+from detector.ngram import seq_text
+from detector.tfidf import Moments, RunningSimilarity, weight
+
+# set CSIDS_VERIFY_TFIDF=1 to cross-check the incremental similarity
+# against a full rebuild of both TF-IDF vectors on every detect() call
+VERIFY_INCREMENTAL = os.environ.get("CSIDS_VERIFY_TFIDF") == "1"
+VERIFY_TOLERANCE   = 1e-9
+
+# scoring engine used by detect(): "tfidf" (dict based, the reference),
+# "sparse" (NumPy vectors, see sparse_engine.py) or "markov" (command
+# transition model, see markov_engine.py)
+DETECT_ENGINE = os.environ.get("CSIDS_ENGINE", "tfidf")
+
+# detect_iter(): windows buffered before the first verdict, so the
+# running similarity has settled, and the cap on distinct windows
+# tracked exactly by the running similarity
+STREAM_WARMUP      = 100
+STREAM_MAX_TRACKED = 1_000_000
+
+# Factor 1 for an unseen window whose trailing n-gram is known
+BACKOFF_PENALTY = 2.0
 
 RISKY_COMMANDS = [
     'nc', 'ncat', 'netcat', 'hydra', 'john', 'hashcat',
@@ -15,52 +41,86 @@ RISKY_COMMANDS = [
     'bash', 'sh', 'eval', 'exec', 'base64', 'dd',
 ]
 
+# regexes, matched case-insensitively — escape literal metacharacters
 DANGEROUS_PATTERNS = [
-    ('/etc/passwd',   3.0, 'accessing password file'),
-    ('/etc/shadow',   5.0, 'accessing shadow password file'),
-    ('/etc/sudoers',  5.0, 'accessing sudoers file'),
-    ('rm -rf',        4.0, 'recursive force delete'),
-    ('| bash',        5.0, 'piping to bash'),
-    ('| sh',          5.0, 'piping to shell'),
-    ('chmod 777',     4.0, 'world writable permission'),
-    ('wget.*|',       4.0, 'download and execute'),
-    ('curl.*|',       4.0, 'download and execute'),
-    ('base64 -d',     3.0, 'possible obfuscation'),
-    ('eval',          4.0, 'code evaluation'),
-    ('4444',          3.0, 'common backdoor port'),
-    ('0.0.0.0',       2.0, 'binding all interfaces'),
-    ('> /etc',        4.0, 'writing to system files'),
-    ('chmod 666',     3.0, 'world readable permission'),
+    (r'/etc/passwd',   3.0, 'accessing password file'),
+    (r'/etc/shadow',   5.0, 'accessing shadow password file'),
+    (r'/etc/sudoers',  5.0, 'accessing sudoers file'),
+    (r'rm -rf',        4.0, 'recursive force delete'),
+    (r'\| bash',       5.0, 'piping to bash'),
+    (r'\| sh',         5.0, 'piping to shell'),
+    (r'chmod 777',     4.0, 'world writable permission'),
+    (r'wget.*\|',      4.0, 'download and execute'),
+    (r'curl.*\|',      4.0, 'download and execute'),
+    (r'base64 -d',     3.0, 'possible obfuscation'),
+    (r'eval',          4.0, 'code evaluation'),
+    (r'4444',          3.0, 'common backdoor port'),
+    (r'0\.0\.0\.0',    2.0, 'binding all interfaces'),
+    (r'> /etc',        4.0, 'writing to system files'),
+    (r'chmod 666',     3.0, 'world readable permission'),
 ]
 
+MATCHER = Matcher(DANGEROUS_PATTERNS, RISKY_COMMANDS)
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# histories repeat the same windows constantly — memoize the scan
+@lru_cache(maxsize=8192)
+def scan_sequence(seq):
+    """MATCHER.scan() of a sequence string or window."""
+    return MATCHER.scan(seq_text(seq))
 
 
 def get_trained_sequences(user):
     """Get all trained sequences and their frequencies."""
     conn = get_db()
     cur  = conn.cursor()
-    cur.execute(
-        "SELECT sequence, frequency FROM user_sequences WHERE user=?",
-        (user,)
-    )
+    cur.execute("""
+        SELECT v.text AS sequence, s.frequency
+        FROM user_sequences s
+        JOIN profile_users  u ON u.id = s.user_id
+        JOIN sequence_vocab v ON v.id = s.sequence_id
+        WHERE u.name=?
+    """, (user,))
     rows = cur.fetchall()
     conn.close()
     return {r['sequence']: r['frequency'] for r in rows}
 
 
-def build_tfidf_profile(trained_sequences):
+def get_profile(user):
+    """
+    Return the compiled profile for a user, loading it on a cache miss
+    from the database or, for a user the database has no profile for,
+    from the CSIDS_SNAPSHOT file if one is configured. Returns None if
+    untrained.
+    """
+    profile = profile_cache.get(user)
+    if profile is None:
+        trained = get_trained_sequences(user)
+        if trained:
+            # local import — profiler needs the app-level database module
+            from detector.profiler import get_moments, get_residual
+            profile = profile_cache.CompiledProfile(
+                trained, get_moments(user), get_residual(user))
+        else:
+            # the database wins, so training and learning still count
+            profile = snapshot.snapshot_profile(user)
+            if profile is None:
+                return None
+        profile_cache.put(user, profile)
+    return profile
+
+
+def build_tfidf_profile(trained_sequences, total=None):
     """
     Build TF-IDF profile from trained sequences.
 
     TF  = frequency of sequence / total sequences
     IDF = log(total / sequences containing this term)
+
+    `total` defaults to the sum of the frequencies; a compacted profile
+    also counts its pruned observations.
     """
-    total = sum(trained_sequences.values())
+    if total is None:
+        total = sum(trained_sequences.values())
     if total == 0:
         return {}
 
@@ -93,26 +153,182 @@ def cosine_similarity(vec1, vec2):
     return dot_product / (mag1 * mag2)
 
 
-def get_pattern_score(sequence):
+def get_pattern_score(sequence, matches=None):
     """Check for dangerous patterns in sequence."""
-    score   = 0.0
-    reasons = []
-    seq_lower = sequence.lower()
-
-    for pattern, pscore, pdesc in DANGEROUS_PATTERNS:
-        if pattern.lower() in seq_lower:
-            score += pscore
-            reasons.append(pdesc)
-
+    if matches is None:
+        matches = MATCHER.scan(seq_text(sequence))
+    score   = sum(pscore for _, pscore, _ in matches.patterns)
+    reasons = [pdesc for _, _, pdesc in matches.patterns]
     return score, reasons
 
 
 def get_risky_cmds(sequence):
     """Extract risky commands from sequence."""
-    return [r for r in RISKY_COMMANDS if r in sequence.lower()]
+    return MATCHER.scan(seq_text(sequence)).substrings
+
+
+def profile_similarity(profile, new_freq):
+    """
+    Cosine similarity between a compiled profile and {sequence: count}
+    of new sequences. Uses the profile's maintained norm, so the cost
+    is proportional to the number of distinct new sequences only.
+    """
+    new_moments = Moments.from_counts(new_freq)
+    new_total   = new_moments.total
+
+    dot_product = 0.0
+    for seq, count in new_freq.items():
+        freq = profile.freq.get(seq)
+        if freq:
+            dot_product += (weight(freq, profile.total) *
+                            weight(count, new_total))
+
+    mag1 = profile.norm()
+    mag2 = new_moments.norm()
+
+    if mag1 == 0 or mag2 == 0:
+        return 0.0
+
+    return dot_product / (mag1 * mag2)
+
+
+def verify_similarity(profile, new_freq, similarity):
+    """
+    Correctness check for the incremental path: rebuild both TF-IDF
+    vectors from scratch and compare. Raises AssertionError on drift.
+    """
+    stored = sum(profile.freq.values())
+    if profile.total != stored + profile.residual:
+        raise AssertionError(
+            f"profile total drifted: {profile.total} != "
+            f"{stored} + residual {profile.residual}")
+
+    # pruned observations count in the total, not in any sequence
+    full        = Moments.from_counts(profile.freq)
+    full.total += profile.residual
+    full_norm   = full.norm()
+    if not math.isclose(profile.norm(), full_norm,
+                        rel_tol=VERIFY_TOLERANCE, abs_tol=VERIFY_TOLERANCE):
+        raise AssertionError(
+            f"profile norm drifted: {profile.norm()} != {full_norm}")
+
+    new_text = {seq_text(seq): n for seq, n in new_freq.items()}
+    expected = cosine_similarity(build_tfidf_profile(profile.freq, profile.total),
+                                 build_tfidf_profile(new_text))
+    if not math.isclose(similarity, expected,
+                        rel_tol=VERIFY_TOLERANCE, abs_tol=VERIFY_TOLERANCE):
+        raise AssertionError(
+            f"similarity mismatch: {similarity} != {expected}")
+
+
+def unseen_penalty(profile, seq):
+    """
+    Factor 1 for a window the profile never stored. Backs off to the
+    longest trailing sub-window the user has run (see ngram.py); a
+    familiar context makes the new window less surprising.
+    """
+    order = profile.freq.context(seq)
+    if order:
+        return BACKOFF_PENALTY, ("sequence never seen in normal behavior "
+                                 f"(last {order} commands are familiar)")
+    return 3.0, "sequence never seen in normal behavior"
+
+
+def score_sequence(seq, profile, overall_anomaly, matches=None):
+    """Return (anomaly score, reasons, risky commands) for one sequence."""
+    trained     = profile.freq
+    seq_anomaly = 0.0
+    reasons     = []
+
+    # Factor 1: Is this sequence in trained profile?
+    if seq not in trained:
+        penalty, reason = unseen_penalty(profile, seq)
+        seq_anomaly += penalty
+        reasons.append(reason)
+    else:
+        # sequence is known — check how rare it is
+        freq_ratio = trained[seq] / profile.total
+        if freq_ratio < 0.01:
+            seq_anomaly += 1.5
+            reasons.append("very rare sequence in normal behavior")
+
+    # Factor 2: Overall behavior similarity
+    if overall_anomaly > 0.7:
+        seq_anomaly += 2.0
+        reasons.append(f"behavior pattern {overall_anomaly*100:.0f}% different from normal")
+    elif overall_anomaly > 0.4:
+        seq_anomaly += 1.0
+        reasons.append(f"behavior pattern {overall_anomaly*100:.0f}% different from normal")
+
+    # Factor 3: Dangerous patterns — one scan also yields risky commands
+    if matches is None:
+        matches = scan_sequence(seq)
+    pattern_score, pattern_reasons = get_pattern_score(seq, matches)
+    seq_anomaly += pattern_score
+    reasons.extend(pattern_reasons)
+
+    # cap at 10
+    return min(seq_anomaly, 10.0), reasons, matches.substrings
+
+
+def make_alert(seq, seq_anomaly, reasons, risky):
+    return {
+        'sequence':   seq_text(seq),
+        'reason':     ' | '.join(reasons),
+        'risk_score': round(seq_anomaly, 2),
+        'risky':      risky,
+    }
+
+
+def detect_tfidf(profile, new_sequences):
+    """Reference engine — dict-based TF-IDF scoring of a batch."""
+    # build frequency dict of new sequences
+    new_freq = Counter(new_sequences)
 
+    # calculate overall similarity score
+    similarity = profile_similarity(profile, new_freq)
+    if VERIFY_INCREMENTAL:
+        verify_similarity(profile, new_freq, similarity)
+
+    # anomaly score = how different from normal
+    # 0 = identical to normal (no anomaly)
+    # 1 = completely different from normal (high anomaly)
+    overall_anomaly = 1.0 - similarity
+
+    # score each distinct sequence once, then report every occurrence
+    scored = {}
+    for seq in new_freq:
+        seq_anomaly, reasons, risky = score_sequence(seq, profile,
+                                                     overall_anomaly)
+        # only alert if anomaly score is significant
+        if seq_anomaly >= 6.0 and reasons:
+            scored[seq] = make_alert(seq, seq_anomaly, reasons, risky)
+
+    return [dict(scored[seq]) for seq in new_sequences if seq in scored]
+
+
+_fallback_warned = []
 
-def detect(user, new_sequences):
+
+def get_engine(name=None):
+    """Resolve an engine name to its scoring function."""
+    name = name or DETECT_ENGINE
+    if name == "sparse":
+        from detector import sparse_engine
+        if sparse_engine.available():
+            return sparse_engine.detect_sparse
+        if not _fallback_warned:
+            print("[DETECT] numpy not installed — using tfidf engine")
+            _fallback_warned.append(name)
+    elif name == "markov":
+        from detector import markov_engine
+        return markov_engine.detect_markov
+    elif name != "tfidf":
+        raise ValueError(f"unknown detection engine '{name}'")
+    return detect_tfidf
+
+
+def detect(user, new_sequences, engine=None):
     """
     Detect intrusion using TF-IDF + Cosine Similarity.
 
@@ -122,75 +338,84 @@ def detect(user, new_sequences):
     3. Calculate cosine similarity between them
     4. Low similarity = unusual behavior = potential intrusion
     5. Also check dangerous patterns for extra scoring
+
+    `engine` overrides DETECT_ENGINE for this call.
     """
-    trained = get_trained_sequences(user)
+    profile = get_profile(user)
 
-    if not trained:
+    if profile is None:
         return [], f"No profile found for '{user}'. Please train first."
 
     if not new_sequences:
         return [], None
 
-    # build TF-IDF profile of normal behavior
-    normal_tfidf = build_tfidf_profile(trained)
+    metrics.DETECTIONS.inc(user=user)
+    with metrics.STAGE_SECONDS.time(stage="detect"):
+        alerts = get_engine(engine)(profile, new_sequences)
+    metrics.ALERTS.inc(len(alerts), user=user)
+    return alerts, None
 
-    # build frequency dict of new sequences
-    new_freq = {}
-    for seq in new_sequences:
-        new_freq[seq] = new_freq.get(seq, 0) + 1
-
-    # build TF-IDF of new sequences
-    new_tfidf = build_tfidf_profile(new_freq)
-
-    # calculate overall similarity score
-    similarity = cosine_similarity(normal_tfidf, new_tfidf)
 
-    # anomaly score = how different from normal
-    # 0 = identical to normal (no anomaly)
-    # 1 = completely different from normal (high anomaly)
-    overall_anomaly = 1.0 - similarity
+class DetectionStream:
+    """
+    Iterable of alerts for a stream of sequences, scored as they arrive.
+
+    The overall-similarity factor comes from running counts
+    (tfidf.RunningSimilarity) instead of the whole batch, so memory
+    stays bounded however long the input is. The first `warmup`
+    windows are held back and scored together once the running
+    similarity has something to go on; inputs shorter than that get
+    exactly the verdicts detect() would give.
+    """
 
-    alerts = []
+    def __init__(self, profile, sequences, warmup=STREAM_WARMUP,
+                 max_tracked=STREAM_MAX_TRACKED):
+        self.profile    = profile
+        self.sequences  = sequences
+        self.warmup     = warmup
+        self.running    = RunningSimilarity(profile, max_tracked)
+        self.total      = 0
+        self.similarity = 0.0
+
+    def _score(self, batch):
+        self.similarity = self.running.similarity()
+        overall_anomaly = 1.0 - self.similarity
+        for seq in batch:
+            seq_anomaly, reasons, risky = score_sequence(
+                seq, self.profile, overall_anomaly)
+            if seq_anomaly >= 6.0 and reasons:
+                yield make_alert(seq, seq_anomaly, reasons, risky)
+
+    def __iter__(self):
+        pending = []
+        for seq in self.sequences:
+            self.total += 1
+            self.running.add(seq)
+            if pending is None:
+                yield from self._score((seq,))
+            else:
+                pending.append(seq)
+                if len(pending) >= self.warmup:
+                    yield from self._score(pending)
+                    pending = None
+        if pending:
+            yield from self._score(pending)
+
+
+def detect_iter(user, sequences, warmup=STREAM_WARMUP, engine=None):
+    """
+    Streaming counterpart of detect(): returns (stream, error) where
+    stream is a DetectionStream yielding alerts incrementally.
+    `sequences` may be any iterable, e.g. iter_windows(...).
+    """
+    profile = get_profile(user)
 
-    for seq in new_sequences:
-        seq_anomaly = 0.0
-        reasons     = []
+    if profile is None:
+        return None, f"No profile found for '{user}'. Please train first."
 
-        # Factor 1: Is this sequence in trained profile?
-        if seq not in trained:
-            seq_anomaly += 3.0
-            reasons.append("sequence never seen in normal behavior")
-        else:
-            # sequence is known — check how rare it is
-            freq_ratio = trained[seq] / sum(trained.values())
-            if freq_ratio < 0.01:
-                seq_anomaly += 1.5
-                reasons.append("very rare sequence in normal behavior")
-
-        # Factor 2: Overall behavior similarity
-        if overall_anomaly > 0.7:
-            seq_anomaly += 2.0
-            reasons.append(f"behavior pattern {overall_anomaly*100:.0f}% different from normal")
-        elif overall_anomaly > 0.4:
-            seq_anomaly += 1.0
-            reasons.append(f"behavior pattern {overall_anomaly*100:.0f}% different from normal")
-
-        # Factor 3: Dangerous patterns
-        pattern_score, pattern_reasons = get_pattern_score(seq)
-        seq_anomaly += pattern_score
-        reasons.extend(pattern_reasons)
-
-        # cap at 10
-        seq_anomaly = min(seq_anomaly, 10.0)
+    metrics.DETECTIONS.inc(user=user)
+    if (engine or DETECT_ENGINE) == "markov":
+        from detector.markov_engine import MarkovStream
+        return MarkovStream(profile, sequences, warmup), None
 
-        # only alert if anomaly score is significant
-        if seq_anomaly >= 6.0 and reasons:
-            risky = get_risky_cmds(seq)
-            alerts.append({
-                'sequence':   seq,
-                'reason':     ' | '.join(reasons),
-                'risk_score': round(seq_anomaly, 2),
-                'risky':      risky,
-            })
-
-    return alerts, None
\ No newline at end of file
+    return DetectionStream(profile, sequences, warmup), None
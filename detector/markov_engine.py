@@ -0,0 +1,313 @@
+"""
+Markov transition scoring engine.
+
+Instead of asking whether an exact window was seen before, this engine
+asks how likely each step from one command to the next is for the
+user. Commands are reduced to their base command ("cat PATH" -> "cat")
+and the model is first- or second-order (MARKOV_ORDER): the chance of
+the next base command given the previous one or two.
+
+Transition counts come straight from the profile trie (ngram.py): the
+count of a depth-(order + 1) path is the count of that transition.
+Probabilities are add-alpha smoothed, and their logs are precomputed
+as two tables, log(c + alpha) per transition and log(n + alpha V) per
+context, so the surprise (-log p) of a step is two dict lookups and a
+subtraction. Profile updates change the counts and the table entries
+they touch in place (MarkovModel.apply). A MarkovScorer walks a
+command stream and yields the surprise of each step in O(1).
+
+A window is scored on the mean surprise of its steps; the overall
+factor compares the batch's mean surprise with the user's own average
+(the model's entropy). Alerts have the same shape as detect_tfidf()'s.
+
+Select it with CSIDS_ENGINE=markov.
+"""
+import math
+import os
+from collections import deque
+
+from detector.ngram import seq_commands
+from detector.sequence_builder import NGRAM_ORDER
+
+MARKOV = "markov"
+
+MARKOV_ORDER = int(os.environ.get("CSIDS_MARKOV_ORDER", 1))
+MARKOV_ALPHA = 0.1
+
+# Factor 1 thresholds on the mean step surprise of a window
+UNLIKELY_SURPRISE = -math.log(0.01)
+RARE_SURPRISE     = -math.log(0.05)
+
+
+def base_command(cmd):
+    parts = cmd.split()
+    return parts[0] if parts else cmd
+
+
+class MarkovModel:
+    """
+    Smoothed transition counts of one user's base commands.
+
+    The user's average surprise per step (the entropy) is kept as
+
+        (sum over contexts of n log(n + alpha V) - sum of c log(c + alpha)) / steps
+
+    with n a context's count, c a transition's count and V the
+    vocabulary size, so apply() updates it, like the log tables, in
+    O(1) per changed transition. Only a new command in the vocabulary
+    (V changes) costs a pass over the contexts.
+    """
+
+    def __init__(self, trie, order=MARKOV_ORDER):
+        self.order   = order
+        self.counts  = {}       # {context: {next command: count}}
+        self.context = {}       # {context: count}
+        self.vocab   = set()
+        self.log_c   = {}       # {context: {next command: log(c + alpha)}}
+        self.log_n   = {}       # {context: log(n + alpha V)}
+
+        # depth of every trie node; parents are always created first
+        depth = [0] * len(trie.total)
+        for node in range(1, len(trie.total)):
+            depth[node] = depth[trie.parent[node]] + 1
+            if depth[node] == 1:
+                self.vocab.add(base_command(trie.cmds[trie.cmd[node]]))
+            elif depth[node] == order + 1:
+                path = []
+                n    = node
+                while n > 0:
+                    path.append(base_command(trie.cmds[trie.cmd[n]]))
+                    n = trie.parent[n]
+                path.reverse()
+                self._count(tuple(path[:-1]), path[-1], trie.total[node])
+
+        self.steps  = sum(self.context.values())
+        self._trans = sum(_xlog(c) for nxt in self.counts.values()
+                          for c in nxt.values())
+        self.log_c  = {ctx: {cmd: math.log(c + MARKOV_ALPHA)
+                             for cmd, c in nxt.items()}
+                       for ctx, nxt in self.counts.items()}
+        self._resize()
+
+    def _count(self, ctx, cmd, delta):
+        nxt      = self.counts.setdefault(ctx, {})
+        nxt[cmd] = nxt.get(cmd, 0) + delta
+        self.context[ctx] = self.context.get(ctx, 0) + delta
+
+    def _resize(self):
+        # one extra slot in the vocabulary for commands never seen
+        self.vocab_size = len(self.vocab) + 1
+        self._smooth    = MARKOV_ALPHA * self.vocab_size
+        self._unseen    = math.log(self.vocab_size)
+        self.log_n      = {ctx: math.log(n + self._smooth)
+                           for ctx, n in self.context.items()}
+        self._contexts  = sum(self._nlog(n) for n in self.context.values())
+
+    def _nlog(self, n):
+        return n * math.log(n + self._smooth) if n > 0 else 0.0
+
+    @property
+    def entropy(self):
+        """The user's own average surprise per step."""
+        if not self.steps:
+            return 0.0
+        return (self._contexts - self._trans) / self.steps
+
+    def apply(self, counts):
+        """Add {sequence: delta} profile updates to the transition counts."""
+        grown = False
+        for seq, delta in counts.items():
+            cmds = [base_command(c) for c in seq_commands(seq)]
+            if cmds and cmds[0] not in self.vocab:
+                self.vocab.add(cmds[0])
+                grown = True
+            if len(cmds) <= self.order:
+                continue
+            ctx, cmd = tuple(cmds[:self.order]), cmds[self.order]
+            old_c    = self.counts.get(ctx, {}).get(cmd, 0)
+            old_n    = self.context.get(ctx, 0)
+            self._count(ctx, cmd, delta)
+            self.log_c.setdefault(ctx, {})[cmd] = \
+                math.log(old_c + delta + MARKOV_ALPHA)
+            self.log_n[ctx] = math.log(old_n + delta + self._smooth)
+            self.steps     += delta
+            self._trans    += _xlog(old_c + delta) - _xlog(old_c)
+            self._contexts += self._nlog(old_n + delta) - self._nlog(old_n)
+        if grown:
+            self._resize()
+
+    def surprise(self, ctx, cmd):
+        """-log P(cmd | ctx) for base commands."""
+        log_n = self.log_n.get(ctx)
+        if log_n is None:
+            # context never seen — every next command is equally likely
+            return self._unseen
+        return log_n - self.log_c[ctx].get(cmd, _LOG_ALPHA)
+
+
+_LOG_ALPHA = math.log(MARKOV_ALPHA)
+
+
+def _xlog(c):
+    return c * math.log(c + MARKOV_ALPHA) if c > 0 else 0.0
+
+
+class MarkovScorer:
+    """Streams commands through a model, one surprise value per step."""
+
+    def __init__(self, model):
+        self.model   = model
+        self.history = deque(maxlen=model.order)
+
+    def reset(self):
+        """Forget the context, e.g. to start on the next window."""
+        self.history.clear()
+
+    def push(self, cmd):
+        """Score the step to `cmd`; None until there is enough context."""
+        base = base_command(cmd)
+        s    = None
+        if len(self.history) == self.model.order:
+            s = self.model.surprise(tuple(self.history), base)
+        self.history.append(base)
+        return s
+
+
+def window_surprise(scorer, seq):
+    """
+    Mean step surprise inside one window, or None if it has no steps.
+    `scorer` is a MarkovScorer, reused from window to window.
+    """
+    scorer.reset()
+    steps = [s for s in map(scorer.push, seq_commands(seq)) if s is not None]
+    return sum(steps) / len(steps) if steps else None
+
+
+def markov_model(profile):
+    form = profile.derived.get(MARKOV)
+    if form is None:
+        # kept up to date by CompiledProfile.apply() from then on.
+        # a step of order k needs trie paths of k + 1 commands
+        order = max(1, min(MARKOV_ORDER, NGRAM_ORDER - 1))
+        form  = profile.derived[MARKOV] = MarkovModel(profile.freq, order)
+    return form
+
+
+def score_window(seq, surprise, overall_anomaly, matches):
+    """Return (anomaly score, reasons) for one window."""
+    from detector.detector import get_pattern_score
+
+    seq_anomaly = 0.0
+    reasons     = []
+
+    # Factor 1: how likely are this window's command transitions?
+    if surprise is not None:
+        p = math.exp(-surprise)
+        if surprise >= UNLIKELY_SURPRISE:
+            seq_anomaly += 3.0
+            reasons.append(f"command transitions unlikely for this user (p={p:.3f})")
+        elif surprise >= RARE_SURPRISE:
+            seq_anomaly += 1.5
+            reasons.append(f"rare command transitions for this user (p={p:.3f})")
+
+    # Factor 2: overall behavior, as extra surprise over the user's norm
+    if overall_anomaly > 0.7:
+        seq_anomaly += 2.0
+        reasons.append(f"behavior pattern {overall_anomaly*100:.0f}% different from normal")
+    elif overall_anomaly > 0.4:
+        seq_anomaly += 1.0
+        reasons.append(f"behavior pattern {overall_anomaly*100:.0f}% different from normal")
+
+    # Factor 3: dangerous patterns
+    pattern_score, pattern_reasons = get_pattern_score(seq, matches)
+    seq_anomaly += pattern_score
+    reasons.extend(pattern_reasons)
+
+    return min(seq_anomaly, 10.0), reasons
+
+
+def overall_anomaly(model, surprise_sum, steps):
+    """0 while the mean surprise is at the user's norm, towards 1 above it."""
+    if not steps:
+        return 0.0
+    excess = surprise_sum / steps - model.entropy
+    return 1.0 - math.exp(-max(excess, 0.0))
+
+
+def _alert(seq, surprise, overall):
+    from detector.detector import scan_sequence, make_alert
+
+    matches = scan_sequence(seq)
+    seq_anomaly, reasons = score_window(seq, surprise, overall, matches)
+    if seq_anomaly >= 6.0 and reasons:
+        return make_alert(seq, seq_anomaly, reasons, matches.substrings)
+    return None
+
+
+def detect_markov(profile, new_sequences):
+    """Score a batch of windows with the user's transition model."""
+    model  = markov_model(profile)
+    scorer = MarkovScorer(model)
+
+    # windows repeat — score each distinct one once
+    surprises = {}
+    for seq in new_sequences:
+        if seq not in surprises:
+            surprises[seq] = window_surprise(scorer, seq)
+
+    observed = [surprises[seq] for seq in new_sequences
+                if surprises[seq] is not None]
+    overall  = overall_anomaly(model, sum(observed), len(observed))
+
+    scored = {}
+    for seq, surprise in surprises.items():
+        alert = _alert(seq, surprise, overall)
+        if alert:
+            scored[seq] = alert
+
+    return [dict(scored[seq]) for seq in new_sequences if seq in scored]
+
+
+class MarkovStream:
+    """
+    Streaming counterpart of detect_markov(), interchangeable with
+    detector.DetectionStream: the overall factor comes from the running
+    mean surprise, and the first `warmup` windows are held back and
+    scored together.
+    """
+
+    def __init__(self, profile, sequences, warmup):
+        self.model      = markov_model(profile)
+        self.scorer     = MarkovScorer(self.model)
+        self.sequences  = sequences
+        self.warmup     = warmup
+        self.total      = 0
+        self.similarity = 0.0
+        self._sum       = 0.0
+        self._steps     = 0
+
+    def _score(self, batch):
+        overall         = overall_anomaly(self.model, self._sum, self._steps)
+        self.similarity = 1.0 - overall
+        for seq, surprise in batch:
+            alert = _alert(seq, surprise, overall)
+            if alert:
+                yield alert
+
+    def __iter__(self):
+        pending = []
+        for seq in self.sequences:
+            self.total += 1
+            surprise = window_surprise(self.scorer, seq)
+            if surprise is not None:
+                self._sum   += surprise
+                self._steps += 1
+            if pending is None:
+                yield from self._score(((seq, surprise),))
+            else:
+                pending.append((seq, surprise))
+                if len(pending) >= self.warmup:
+                    yield from self._score(pending)
+                    pending = None
+        if pending:
+            yield from self._score(pending)
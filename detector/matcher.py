@@ -0,0 +1,144 @@
+"""
+Single-pass multi-pattern matcher.
+
+Scoring a sequence used to take one substring scan per dangerous
+pattern, another per risky command, and a freshly compiled `\\b...\\b`
+regex per command for token matches. A Matcher compiles all of them
+into one regex, built once, so a single left-to-right scan reports
+everything:
+
+    patterns   - (regex, score, description) rules, matched against
+                 the lowercased text (write them in lower case)
+    substrings - words reported wherever they occur (detector semantics)
+    tokens     - words reported only on \\b word boundaries
+                 (preprocess semantics, case-sensitive)
+
+The words are folded into a prefix trie so the regex engine walks them
+like an automaton, and everything sits inside a lookahead so matches
+may overlap. At any offset the trie reports the longest word; shorter
+words starting there are its prefixes and come from a lookup table.
+"""
+import re
+from collections import namedtuple
+
+Matches = namedtuple("Matches", ["patterns", "substrings", "tokens"])
+
+_REGEX_META = set(".^$*+?{}[]|()")
+
+
+def _first_char(regex):
+    """Literal first character of a regex, or None if it starts with a metachar."""
+    if not regex:
+        return None
+    if regex[0] == "\\":
+        nxt = regex[1:2]
+        return nxt if nxt and not nxt.isalnum() else None
+    return None if regex[0] in _REGEX_META else regex[0]
+
+
+def _trie_regex(words):
+    """Regex matching the longest of `words` at a position, factored by prefix."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def emit(node):
+        alts = [re.escape(ch) + emit(child)
+                for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        # greedy optional tail — prefer the longer word
+        return "(?:" + body + ")?" if "" in node else body
+
+    return emit(trie)
+
+
+def _is_word(ch):
+    return ch.isalnum() or ch == "_"
+
+
+def _at_boundary(text, i):
+    """Same test as regex \\b at offset i."""
+    before = i > 0 and _is_word(text[i - 1])
+    after  = i < len(text) and _is_word(text[i])
+    return before != after
+
+
+class Matcher:
+    """Compiled scanner for dangerous patterns and risky commands."""
+
+    def __init__(self, patterns=(), substrings=(), tokens=()):
+        self.patterns   = list(patterns)
+        self.substrings = list(substrings)
+        self.tokens     = list(tokens)
+        self._token_set = set(self.tokens)
+        # lowercased substring -> first index in the table
+        self._order = {}
+        for i, w in enumerate(self.substrings):
+            self._order.setdefault(w.lower(), i)
+
+        words = sorted({w.lower() for w in self.substrings + self.tokens})
+        self._prefixes = {
+            w: [p for p in words if p != w and w.startswith(p)] for w in words
+        }
+
+        self._rules   = [re.compile(rx) for rx, _, _ in self.patterns]
+        self._buckets = {}
+        for i, (rx, _, _) in enumerate(self.patterns):
+            self._buckets.setdefault(_first_char(rx), []).append(i)
+
+        # group 1: a rule matched here, group 2: longest word here
+        rules = "|".join(f"(?:{rx})" for rx, _, _ in self.patterns) or "(?!)"
+        trie  = _trie_regex(words) if words else "(?!)"
+        self._scanner = re.compile(f"(?=({rules})|{trie})(?=({trie}))?")
+
+    def scan(self, text):
+        """Return Matches for `text` in one pass, each list in table order."""
+        low = text.lower()
+
+        if self.tokens:
+            found = [(m.start(), m.group(1), m.group(2))
+                     for m in self._scanner.finditer(low)]
+            pairs = [(r, w) for _, r, w in found]
+        else:
+            pairs = self._scanner.findall(low)
+
+        rule_hits = set()
+        word_hits = set()
+        for rule_text, word in pairs:
+            if rule_text and len(rule_hits) < len(self._rules):
+                # the winning rule and any sharing its first character
+                for j in self._buckets.get(rule_text[0], []) + \
+                        self._buckets.get(None, []):
+                    if j not in rule_hits and self._rules[j].search(low):
+                        rule_hits.add(j)
+            if word and word not in word_hits:
+                word_hits.add(word)
+                word_hits.update(self._prefixes[word])
+
+        token_hits = set()
+        if self.tokens and len(low) == len(text):
+            for pos, _, word in found:
+                if not word:
+                    continue
+                for w in [word] + self._prefixes[word]:
+                    end = pos + len(w)
+                    if w in self._token_set and text[pos:end] == w \
+                            and _at_boundary(text, pos) and _at_boundary(text, end):
+                        token_hits.add(w)
+        elif self.tokens:
+            # lowercasing shifted offsets (rare unicode) — check directly
+            token_hits = {w for w in self.tokens
+                          if re.search(r"\b" + re.escape(w) + r"\b", text)}
+
+        substrings = sorted(word_hits.intersection(self._order),
+                            key=self._order.__getitem__)
+        return Matches(
+            [self.patterns[i] for i in sorted(rule_hits)],
+            [self.substrings[self._order[w]] for w in substrings],
+            [w for w in self.tokens if w in token_hits],
+        )
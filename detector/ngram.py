@@ -0,0 +1,167 @@
+"""
+Multi-order n-gram profiles stored as a prefix trie.
+
+A profile row is a window of commands joined by " | ". Inserting it
+walks one path from the root, so a single pass over the rows counts
+every order at once:
+
+    total[node] - windows passing through the node, i.e. the count of
+                  the n-gram spelled by its path (unigram at depth 1,
+                  bigram at depth 2, ...)
+    freq[node]  - windows ending exactly there, i.e. the stored row
+
+The trie is kept flat to stay small in CPython: commands are interned
+to integer ids, nodes are indexes into typed arrays, and the edges are
+one dict keyed by (parent << 32 | command id). Holding every order up
+to N this way costs about half of what one dict per order would.
+
+NgramTrie also behaves as a read-only {sequence: frequency} mapping
+over the stored rows, which is what the TF-IDF engines expect of a
+profile. When a sequence was never stored, context() backs off to the
+longest trailing sub-window the profile has seen.
+
+Lookups take a sequence either as its " | "-joined text or as a window
+tuple of commands (sequence_builder.iter_windows); a window is walked
+as it is, never joined.
+"""
+import sys
+from array import array
+
+SEP = " | "
+
+_CMD_BITS = 32
+
+
+def seq_commands(seq):
+    """The commands of a sequence string or window tuple."""
+    return seq.split(SEP) if isinstance(seq, str) else seq
+
+
+def seq_text(seq):
+    """The stored text of a sequence string or window tuple."""
+    return seq if isinstance(seq, str) else SEP.join(seq)
+
+# bytes per node: edge dict slot + key/value ints + four array cells
+_NODE_OVERHEAD = 130
+
+
+class NgramTrie:
+    """Prefix trie of command windows with per-order counts."""
+
+    def __init__(self, counts=None):
+        self.cmd_ids = {}
+        self.cmds    = []
+        self.edges   = {}
+        self.total   = array("q", [0])
+        self.freq    = array("q", [0])
+        self.parent  = array("q", [-1])
+        self.cmd     = array("q", [-1])
+        self.size    = 0        # number of stored rows (freq > 0)
+        self.nbytes  = 0
+        if counts:
+            self.update(counts)
+
+    # ── writes ────────────────────────────────────────────────
+
+    def add(self, seq, count=1):
+        """Add `count` occurrences of a window to every order it spans."""
+        node = 0
+        self.total[0] += count
+        for cmd in seq.split(SEP):
+            c = self.cmd_ids.get(cmd)
+            if c is None:
+                c = self.cmd_ids[cmd] = len(self.cmds)
+                self.cmds.append(cmd)
+                self.nbytes += sys.getsizeof(cmd) + _NODE_OVERHEAD
+            key   = (node << _CMD_BITS) | c
+            child = self.edges.get(key)
+            if child is None:
+                child = self.edges[key] = len(self.total)
+                self.total.append(0)
+                self.freq.append(0)
+                self.parent.append(node)
+                self.cmd.append(c)
+                self.nbytes += _NODE_OVERHEAD
+            self.total[child] += count
+            node = child
+        old = self.freq[node]
+        self.freq[node] = old + count
+        self.size += (old + count > 0) - (old > 0)
+        return old + count
+
+    def update(self, counts):
+        """Add a {sequence: delta} map."""
+        for seq, count in counts.items():
+            self.add(seq, count)
+
+    # ── n-gram queries ────────────────────────────────────────
+
+    def _find(self, cmds):
+        node = 0
+        for cmd in cmds:
+            c = self.cmd_ids.get(cmd)
+            if c is None:
+                return None
+            node = self.edges.get((node << _CMD_BITS) | c)
+            if node is None:
+                return None
+        return node
+
+    def count(self, cmds):
+        """Count of the n-gram `cmds` (a list of commands) at its own order."""
+        node = self._find(cmds)
+        return self.total[node] if node is not None else 0
+
+    def context(self, seq):
+        """
+        Back-off for an unseen window: the length of the longest
+        trailing sub-window of `seq` (at least a bigram) that the
+        profile has seen, or 0 if none.
+        """
+        cmds = seq_commands(seq)
+        for k in range(len(cmds) - 1, 1, -1):
+            if self.count(cmds[-k:]):
+                return k
+        return 0
+
+    def _path(self, node):
+        cmds = []
+        while node > 0:
+            cmds.append(self.cmds[self.cmd[node]])
+            node = self.parent[node]
+        return SEP.join(reversed(cmds))
+
+    # ── mapping over stored rows ──────────────────────────────
+
+    def get(self, seq, default=None):
+        node = self._find(seq_commands(seq))
+        if node is None or self.freq[node] == 0:
+            return default
+        return self.freq[node]
+
+    def __getitem__(self, seq):
+        freq = self.get(seq)
+        if freq is None:
+            raise KeyError(seq)
+        return freq
+
+    def __contains__(self, seq):
+        return self.get(seq) is not None
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        """Yield (sequence, frequency) for every stored row."""
+        for node, freq in enumerate(self.freq):
+            if freq:
+                yield self._path(node), freq
+
+    def __iter__(self):
+        return (seq for seq, _ in self.items())
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (freq for freq in self.freq if freq)
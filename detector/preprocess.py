@@ -1,4 +1,9 @@
+import os
 import re
+from functools import lru_cache
+
+from detector.matcher import Matcher
+from detector.ngram import SEP
 
 RISKY_COMMANDS = {
     # privilege escalation
@@ -45,88 +50,220 @@ SENSITIVE_PATHS = [
 ]
 
 
-def clean_commands(raw_lines):
-    cleaned = []
-    for line in raw_lines:
-        line = line.strip()
+# compiled once — normalize_command() runs for every history line
+_NUM_RE       = re.compile(r"\b\d{5,}\b")
+_PATH_RE      = re.compile(r"/(?:[a-zA-Z0-9_\-\.]+/)+[a-zA-Z0-9_\-\.]*")
+_IP_RE        = re.compile(r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b")
+_SENSITIVE_RE = re.compile("|".join(re.escape(sp) for sp in SENSITIVE_PATHS))
+_SENSITIVE_TAGS = [
+    (sp, "SENSITIVE_" + sp.strip("/").replace("/", "_").replace(".", "_").upper())
+    for sp in SENSITIVE_PATHS
+]
+
+# histories repeat the same lines constantly — memoize the normalizer
+NORMALIZE_CACHE_SIZE = int(os.environ.get("CSIDS_NORMALIZE_CACHE", 65536))
+
+
+def normalize_command(line):
+    """Normalize one raw history line; returns None for lines to skip."""
+    line = line.strip()
 
-        if not line or line.startswith("#"):
-            continue
+    # also covers bash timestamp lines (#1700000000)
+    if not line or line.startswith("#"):
+        return None
 
-        # skip bash timestamp lines
-        if re.match(r"^#\d+$", line):
-            continue
+    return _normalize(line)
 
-        cmd = line.lower()
 
-        # normalize large numbers only
-        cmd = re.sub(r"\b\d{5,}\b", "NUM", cmd)
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _normalize(line):
+    cmd = line.lower()
 
-        # ✅ tag sensitive paths BEFORE replacing anything
-        for sp in SENSITIVE_PATHS:
+    # normalize large numbers only
+    cmd = _NUM_RE.sub("NUM", cmd)
+
+    # ✅ tag sensitive paths BEFORE replacing anything. One scan finds
+    # out whether any are present; tagging then replaces them in list
+    # order, as each replacement can hide a later, overlapping path
+    if _SENSITIVE_RE.search(cmd):
+        for sp, tag in _SENSITIVE_TAGS:
             if sp in cmd:
-                tag = "SENSITIVE_" + sp.strip("/").replace("/", "_").replace(".", "_").upper()
                 cmd = cmd.replace(sp, tag)
 
-        # replace remaining generic paths
-        cmd = re.sub(r"/(?:[a-zA-Z0-9_\-\.]+/)+[a-zA-Z0-9_\-\.]*", "PATH", cmd)
+    # replace remaining generic paths
+    if "/" in cmd:
+        cmd = _PATH_RE.sub("PATH", cmd)
 
-        # normalize IPs
-        cmd = re.sub(r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b", "IP_ADDR", cmd)
+    # normalize IPs
+    if "." in cmd:
+        cmd = _IP_RE.sub("IP_ADDR", cmd)
 
-        cleaned.append(cmd)
-    return cleaned
+    return cmd
 
 
-def get_risky_commands_in(text):
-    """Return list of risky commands found in a sequence string."""
-    found = []
-    for cmd in RISKY_COMMANDS:
-        if re.search(r"\b" + re.escape(cmd) + r"\b", text):
-            found.append(cmd)
-    return found
+def _reference_normalize(line):
+    """The original uncompiled normalizer, kept for check_normalizer()."""
+    line = line.strip()
 
+    if not line or line.startswith("#"):
+        return None
 
-def get_risk_score(sequence):
+    # skip bash timestamp lines
+    if re.match(r"^#\d+$", line):
+        return None
+
+    cmd = line.lower()
+
+    # normalize large numbers only
+    cmd = re.sub(r"\b\d{5,}\b", "NUM", cmd)
+
+    # ✅ tag sensitive paths BEFORE replacing anything
+    for sp in SENSITIVE_PATHS:
+        if sp in cmd:
+            tag = "SENSITIVE_" + sp.strip("/").replace("/", "_").replace(".", "_").upper()
+            cmd = cmd.replace(sp, tag)
+
+    # replace remaining generic paths
+    cmd = re.sub(r"/(?:[a-zA-Z0-9_\-\.]+/)+[a-zA-Z0-9_\-\.]*", "PATH", cmd)
+
+    # normalize IPs
+    cmd = re.sub(r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b", "IP_ADDR", cmd)
+
+    return cmd
+
+
+def check_normalizer(raw_lines):
     """
-    Calculate risk score 0.0 - 10.0 for a sequence string.
-    Higher = more suspicious.
+    Run the compiled and the reference normalizer over the same lines
+    and return the (line, expected, actual) mismatches; empty means
+    byte-identical output.
     """
-    import re as _re
-    score = 0
-    parts = sequence.split(" | ")
+    diffs = []
+    for line in raw_lines:
+        expected = _reference_normalize(line)
+        actual   = normalize_command(line)
+        if expected != actual:
+            diffs.append((line, expected, actual))
+    return diffs
+
 
-    for part in parts:
-        base_cmd = part.split()[0] if part.split() else ""
+def iter_clean_commands(raw_lines):
+    """Streaming clean_commands() — yields one normalized command at a time."""
+    for line in raw_lines:
+        cmd = normalize_command(line)
+        if cmd is not None:
+            yield cmd
+
+
+def clean_commands(raw_lines):
+    return list(iter_clean_commands(raw_lines))
 
-        # command weight
-        score += RISKY_COMMANDS.get(base_cmd, 0)
 
-        # sensitive path access
-        if "SENSITIVE_" in part:
-            score += 3
+def read_history(path):
+    """Yield raw lines from a history file without loading it whole."""
+    with open(path, errors="replace") as f:
+        yield from f
 
-        # piped commands (chaining is suspicious)
-        if "|" in part:
-            score += 1
 
-        # output redirected somewhere sensitive
-        if _re.search(r">\s*SENSITIVE_", part):
-            score += 2
+# compiled once — token-boundary matches for every risky command
+_TOKEN_MATCHER = Matcher(tokens=RISKY_COMMANDS)
 
-        # encoded payloads
-        if "base64" in part or "xxd" in part:
-            score += 2
+_REDIRECT_RE = re.compile(r">\s*SENSITIVE_")
+
+
+class CommandRecord:
+    """
+    One normalized command, scored once.
 
-        # background execution
-        if part.strip().endswith("&"):
-            score += 1
+        text  - the normalized command, as stored in profiles
+        risk  - get_risk_score() points, over `parts` segments
 
-        # downloading and executing
-        if base_cmd in ("wget", "curl") and ("|" in part or "bash" in part):
-            score += 3
+    Records come from parse_command(), which interns them, so windows
+    and the risk scorer reuse the same record for a repeated command.
+    """
+    __slots__ = ("text", "risk", "parts")
+
+    def __init__(self, text):
+        self.text  = text
+
+        # a command holding " | " scores as the segments a joined
+        # sequence string would split into, as it always has
+        segments   = text.split(SEP)
+        self.risk  = sum(_segment_risk(part) for part in segments)
+        self.parts = len(segments)
+
+    def __eq__(self, other):
+        if isinstance(other, CommandRecord):
+            return self.text == other.text
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return f"CommandRecord({self.text!r})"
+
+
+def _segment_risk(part):
+    """Risk points of one " | "-separated segment of a sequence."""
+    words    = part.split()
+    base_cmd = words[0] if words else ""
+    score    = 0
+
+    # command weight
+    score += RISKY_COMMANDS.get(base_cmd, 0)
+
+    # sensitive path access
+    if "SENSITIVE_" in part:
+        score += 3
+
+    # piped commands (chaining is suspicious)
+    if "|" in part:
+        score += 1
+
+    # output redirected somewhere sensitive
+    if _REDIRECT_RE.search(part):
+        score += 2
+
+    # encoded payloads
+    if "base64" in part or "xxd" in part:
+        score += 2
+
+    # background execution
+    if part.strip().endswith("&"):
+        score += 1
+
+    # downloading and executing
+    if base_cmd in ("wget", "curl") and ("|" in part or "bash" in part):
+        score += 3
+
+    return score
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def parse_command(cmd):
+    """The interned CommandRecord of a normalized command."""
+    return CommandRecord(cmd)
+
+
+def get_risky_commands_in(text):
+    """Return list of risky commands found in a sequence string."""
+    return _TOKEN_MATCHER.scan(text).tokens
+
+
+def get_risk_score(sequence):
+    """
+    Calculate risk score 0.0 - 10.0 for a sequence string, a window
+    of commands (see sequence_builder.iter_windows) or a window of
+    CommandRecords. Higher = more suspicious.
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.split(SEP)
+    records = [cmd if isinstance(cmd, CommandRecord) else parse_command(cmd)
+               for cmd in sequence]
 
-    max_possible = len(parts) * 9
+    score        = sum(r.risk for r in records)
+    max_possible = sum(r.parts for r in records) * 9
     if max_possible == 0:
         return 0.0
-    return round(min((score / max_possible) * 10, 10.0), 2)
\ No newline at end of file
+    return round(min((score / max_possible) * 10, 10.0), 2)
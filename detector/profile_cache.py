@@ -0,0 +1,178 @@
+"""
+Per-process cache of compiled user profiles.
+
+Loading a profile means pulling every row of a user's `user_sequences`
+table and rebuilding the TF-IDF vector, which used to happen on every
+call to detect(). The cache keeps the compiled form in memory:
+
+    freq    - NgramTrie of the stored windows, used as a
+              {sequence: frequency} map, see ngram.py
+    moments - running TF-IDF aggregates (total, norm), see tfidf.py
+
+Entries are evicted least-recently-used once either the user count or
+the estimated memory footprint goes over budget. Writers in this
+process (train_user, mark-safe) update entries in place; writes made by
+other processes are picked up once an entry is older than CACHE_TTL.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from detector.ngram import NgramTrie
+from detector.tfidf import Moments, weight
+
+CACHE_MAX_USERS = int(os.environ.get("CSIDS_CACHE_MAX_USERS", 64))
+CACHE_MAX_BYTES = int(os.environ.get("CSIDS_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_TTL       = float(os.environ.get("CSIDS_CACHE_TTL", 30))
+
+class CompiledProfile:
+    """A user's trained profile, ready for scoring."""
+
+    __slots__ = ("freq", "moments", "residual", "loaded_at", "derived")
+
+    def __init__(self, freq, moments=None, residual=0):
+        self.freq      = freq if isinstance(freq, NgramTrie) else NgramTrie(freq)
+        self.moments   = moments or Moments.from_counts(self.freq)
+        # observations of sequences compacted away: in the total only
+        self.residual  = residual
+        self.loaded_at = time.monotonic()
+        # engine-specific compiled forms, keyed by engine name
+        self.derived   = {}
+
+    @property
+    def nbytes(self):
+        return self.freq.nbytes
+
+    @property
+    def total(self):
+        return self.moments.total
+
+    def weight(self, seq):
+        """TF-IDF weight of `seq` in this profile (0 if unseen)."""
+        return weight(self.freq.get(seq, 0), self.moments.total)
+
+    def norm(self):
+        return self.moments.norm()
+
+    def apply(self, counts):
+        """Add {sequence: delta} to the profile in place."""
+        for seq, delta in counts.items():
+            new = self.freq.add(seq, delta)
+            self.moments.change(new - delta, new)
+
+        # derived forms either follow the update or are rebuilt lazily
+        for name, form in list(self.derived.items()):
+            if hasattr(form, "apply"):
+                form.apply(counts)
+            else:
+                del self.derived[name]
+
+
+_lock    = threading.RLock()
+_entries = OrderedDict()
+_bytes   = 0
+_stats   = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def get(user):
+    """Return the cached profile for `user`, or None on a miss."""
+    with _lock:
+        profile = _entries.get(user)
+        if profile is not None and \
+                time.monotonic() - profile.loaded_at > CACHE_TTL:
+            _drop(user)
+            profile = None
+        if profile is None:
+            _stats["misses"] += 1
+            return None
+        _entries.move_to_end(user)
+        _stats["hits"] += 1
+        return profile
+
+
+def put(user, profile):
+    """Insert a freshly loaded profile and evict to stay within budget."""
+    global _bytes
+    with _lock:
+        if user in _entries:
+            _drop(user)
+        _entries[user] = profile
+        _bytes        += profile.nbytes
+        _evict()
+
+
+def update(user, counts):
+    """
+    Write-through hook for profile writers.
+    Applies {sequence: delta} to a cached profile; no-op if not cached.
+    Returns the profile that was updated, or None.
+    """
+    global _bytes
+    with _lock:
+        profile = _entries.get(user)
+        if profile is None:
+            return None
+        before  = profile.nbytes
+        profile.apply(counts)
+        _bytes += profile.nbytes - before
+        _evict()
+        return profile
+
+
+def peek(user):
+    """The cached profile for `user` or None, without counting a lookup."""
+    with _lock:
+        return _entries.get(user)
+
+
+def invalidate(user=None):
+    """Drop one user's profile, or every profile when `user` is None."""
+    global _bytes
+    with _lock:
+        if user is None:
+            _entries.clear()
+            _bytes = 0
+        elif user in _entries:
+            _drop(user)
+
+
+def stats():
+    """Return hit/miss/eviction counters and current memory usage."""
+    with _lock:
+        return dict(_stats, users=len(_entries), bytes=_bytes)
+
+
+def _drop(user):
+    global _bytes
+    profile = _entries.pop(user)
+    _bytes -= profile.nbytes
+
+
+def _evict():
+    while _entries and (len(_entries) > CACHE_MAX_USERS or
+                        _bytes > CACHE_MAX_BYTES):
+        oldest = next(iter(_entries))
+        _drop(oldest)
+        _stats["evictions"] += 1
+
+
+_CACHE_EVENTS = metrics.counter(
+    "csids_profile_cache_events_total",
+    "Profile cache lookups and evictions in this process.")
+_CACHE_RATIO = metrics.gauge(
+    "csids_profile_cache_hit_ratio", "Profile cache hit ratio.")
+_CACHE_SIZE = metrics.gauge(
+    "csids_profile_cache_size", "Cached profiles and their estimated bytes.")
+
+
+@metrics.collector
+def _export_stats():
+    s       = stats()
+    lookups = s["hits"] + s["misses"]
+    for event in ("hits", "misses", "evictions"):
+        _CACHE_EVENTS.set(s[event], event=event)
+    _CACHE_RATIO.set(s["hits"] / lookups if lookups else 0.0)
+    _CACHE_SIZE.set(s["users"], unit="users")
+    _CACHE_SIZE.set(s["bytes"], unit="bytes")
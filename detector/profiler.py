@@ -1,35 +1,400 @@
-from database import get_db
+import os
+import time
+from database import get_db, sequence_hash
 from datetime import datetime
+from collections import Counter, namedtuple
+
+from detector import profile_cache
+from detector.sequence_builder import count_sequences
+from detector.tfidf import Moments
+
+# distinct sequences held in memory before train_user_stream() flushes
+TRAIN_CHUNK = 50_000
+
+# host parameters per "IN (...)" lookup, well under SQLite's limit
+_IN_CHUNK = 500
+
+# sequence occurrences seen vs distinct profile rows written
+TrainResult = namedtuple("TrainResult", ["total", "distinct"])
+
+# per-user size budget enforced by compact_profile() (0 = unbounded)
+PROFILE_MAX_SEQUENCES = int(os.environ.get("CSIDS_PROFILE_MAX_SEQUENCES",
+                                           "100000"))
+# sequences seen at most PRUNE_FREQUENCY times and not for this many
+# days are pruned by compact_profile() (0 = never)
+PROFILE_HORIZON_DAYS  = float(os.environ.get("CSIDS_PROFILE_HORIZON_DAYS",
+                                             "90"))
+PRUNE_FREQUENCY       = 1
+
+# rows removed vs kept by one compact_profile() run
+CompactResult = namedtuple("CompactResult",
+                           ["before", "after", "stale", "over_budget",
+                            "residual", "seconds"])
 
 
 def train_user(user, sequences):
     """
     Train a user's normal behavior profile from sequences.
-    Uses INSERT OR REPLACE to properly upsert — no duplicate rows.
-    Returns count of sequences stored.
+    Sequences are counted in memory first, then each distinct one is
+    upserted once, in bulk, in a single transaction.
+    Returns a TrainResult of total and distinct sequences learned.
+    `sequences` may be any iterable, including a generator, of
+    sequence strings or windows (see iter_windows).
+    """
+    conn = get_db()
+    cur = conn.cursor()
+
+    counts = count_sequences(sequences)
+    learn_sequences(cur, user, counts)
+
+    conn.commit()
+    conn.close()
+
+    # keep this process's cached profile in step with the table
+    profile_cache.update(user, counts)
+    return TrainResult(sum(counts.values()), len(counts))
+
+
+def train_user_stream(user, sequences, chunk_rows=TRAIN_CHUNK):
+    """
+    train_user() for inputs too large to count whole: flushes and
+    commits every `chunk_rows` distinct sequences, so memory stays
+    bounded. A sequence that spans several flushes is counted as
+    distinct once per flush.
+    """
+    conn   = get_db()
+    cur    = conn.cursor()
+    counts = Counter()
+    total  = distinct = 0
+
+    def flush():
+        texts = count_sequences(counts)
+        learn_sequences(cur, user, texts)
+        conn.commit()
+        profile_cache.update(user, texts)
+        counts.clear()
+        return sum(texts.values()), len(texts)
+
+    try:
+        for seq in sequences:
+            counts[seq] += 1
+            if len(counts) >= chunk_rows:
+                t, d = flush()
+                total, distinct = total + t, distinct + d
+        if counts:
+            t, d = flush()
+            total, distinct = total + t, distinct + d
+    finally:
+        conn.close()
+    return TrainResult(total, distinct)
+
+
+def write_lock(cur):
+    """
+    Make sure the cursor's connection holds the write lock. Python's
+    sqlite3 only opens a transaction at the first write, so a
+    transaction that is already open has written and holds it.
+    """
+    if not cur.connection.in_transaction:
+        cur.execute("BEGIN IMMEDIATE")
+
+
+def learn_sequences(cur, user, counts):
     """
+    Upsert {sequence: delta} into a user's profile on an open cursor and
+    keep the user's profile_stats aggregates in step. Does not commit.
+    Takes the write lock (if not held yet) before reading the current
+    aggregates, so concurrent writers cannot overwrite each other's.
+    """
+    write_lock(cur)
+    user_id = _user_id(cur, user, create=True)
+    moments = _load_moments(cur, user_id)
+    ids     = intern_sequences(cur, counts)
+    old     = _frequencies(cur, user_id, ids.values())
+
+    now     = int(time.time())
+
+    # ✅ FIXED — one upsert per distinct sequence, sent as one batch
+    cur.executemany("""
+        INSERT INTO user_sequences (user_id, sequence_id, frequency, last_seen)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, sequence_id)
+        DO UPDATE SET frequency = frequency + excluded.frequency,
+                      last_seen = excluded.last_seen
+    """, [(user_id, ids[seq], delta, now) for seq, delta in counts.items()])
+
+    for seq, delta in counts.items():
+        before = old.get(ids[seq], 0)
+        moments.change(before, before + delta)
+
+    _save_moments(cur, user_id, moments)
+    return moments
+
+
+def _chunks(items, size=_IN_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _lookup_vocab(cur, hashes, ids):
+    """Fill {text: id} for the texts in {text: hash} already interned."""
+    for chunk in _chunks(set(hashes.values())):
+        cur.execute(
+            "SELECT id, hash, text FROM sequence_vocab "
+            f"WHERE hash IN ({','.join('?' * len(chunk))})",
+            chunk
+        )
+        for seq_id, h, text in cur.fetchall():
+            if hashes.get(text) == h:
+                ids[text] = seq_id
+
+
+def intern_sequences(cur, texts):
+    """
+    Return {text: id} from sequence_vocab, adding any texts not seen
+    before. Lookups go through the hash index, a chunk of hashes per
+    query; the text comparison makes a hash collision harmless.
+    """
+    hashes = {text: sequence_hash(text) for text in texts}
+    ids    = {}
+    _lookup_vocab(cur, hashes, ids)
+
+    new = {text: h for text, h in hashes.items() if text not in ids}
+    if new:
+        cur.executemany(
+            "INSERT INTO sequence_vocab (hash, text) VALUES (?, ?)",
+            [(h, text) for text, h in new.items()]
+        )
+        # executemany() has no lastrowid — read the new ids back
+        _lookup_vocab(cur, new, ids)
+    return ids
+
+
+def _frequencies(cur, user_id, sequence_ids):
+    """{sequence_id: frequency} of the given rows in a user's profile."""
+    freq = {}
+    for chunk in _chunks(sequence_ids):
+        cur.execute(
+            "SELECT sequence_id, frequency FROM user_sequences "
+            f"WHERE user_id=? AND sequence_id IN ({','.join('?' * len(chunk))})",
+            [user_id] + chunk
+        )
+        freq.update(cur.fetchall())
+    return freq
+
+
+def _user_id(cur, user, create=False):
+    """Integer id of a profile owner, optionally registering it."""
+    cur.execute("SELECT id FROM profile_users WHERE name=?", (user,))
+    row = cur.fetchone()
+    if row is not None:
+        return row[0]
+    if not create:
+        return None
+    cur.execute("INSERT INTO profile_users (name) VALUES (?)", (user,))
+    return cur.lastrowid
+
+
+def get_moments(user):
+    """Return the maintained TF-IDF aggregates for a user."""
+    conn = get_db()
+    cur = conn.cursor()
+    user_id = _user_id(cur, user)
+    moments = _load_moments(cur, user_id) if user_id else Moments()
+    conn.commit()
+    conn.close()
+    return moments
+
+
+def get_residual(user):
+    """Observations of a user's compacted-away sequences (see keep_residual)."""
+    conn = get_db()
+    cur = conn.cursor()
+    user_id = _user_id(cur, user)
+    residual = _residual(cur, user_id) if user_id else 0
+    conn.close()
+    return residual
+
+
+def rebuild_profile_stats(user):
+    """Recompute a user's aggregates from scratch from user_sequences."""
     conn = get_db()
     cur = conn.cursor()
+    user_id = _user_id(cur, user)
+    if user_id is None:
+        conn.close()
+        return Moments()
+    moments = _compute_moments(cur, user_id)
+    # compacted-away observations still count towards the total
+    moments.total += _residual(cur, user_id)
+    _save_moments(cur, user_id, moments)
+    conn.commit()
+    conn.close()
+    return moments
+
+
+def _compute_moments(cur, user_id):
+    cur.execute(
+        "SELECT sequence_id, frequency FROM user_sequences WHERE user_id=?",
+        (user_id,)
+    )
+    return Moments.from_counts({r[0]: r[1] for r in cur.fetchall()})
+
+
+def _load_moments(cur, user_id):
+    cur.execute("""
+        SELECT total, sum_sq, sum_sq_log, sum_sq_log2
+        FROM profile_stats WHERE user_id=?
+    """, (user_id,))
+    row = cur.fetchone()
+    if row is None:
+        # profile trained before aggregates existed — backfill once
+        moments = _compute_moments(cur, user_id)
+        if moments.total:
+            _save_moments(cur, user_id, moments)
+        return moments
+    return Moments(*row)
+
+
+def _save_moments(cur, user_id, moments):
+    cur.execute("""
+        INSERT INTO profile_stats
+            (user_id, total, sum_sq, sum_sq_log, sum_sq_log2)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            total       = excluded.total,
+            sum_sq      = excluded.sum_sq,
+            sum_sq_log  = excluded.sum_sq_log,
+            sum_sq_log2 = excluded.sum_sq_log2
+    """, (user_id,) + moments.as_row())
+
+
+def _residual(cur, user_id):
+    cur.execute("SELECT residual FROM profile_stats WHERE user_id=?",
+                (user_id,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def keep_residual(cur, user_id, moments, mass):
+    """
+    Record `mass` observations whose sequences are no longer stored:
+    they stay in the profile total (and so in every kept sequence's
+    TF-IDF weight) and in profile_stats.residual. Does not commit.
+    """
+    moments.total += mass
+    _save_moments(cur, user_id, moments)
+    cur.execute("UPDATE profile_stats SET residual = residual + ? "
+                "WHERE user_id=?", (mass, user_id))
+
 
-    for seq in sequences:
-        # ✅ FIXED — single query instead of SELECT then INSERT/UPDATE
+# ── compaction ────────────────────────────────────────────────
+
+def _prune_candidates(cur, user_id, max_sequences, horizon_days):
+    """{sequence_id: frequency} of a profile's stale and over-budget rows."""
+    stale = {}
+    if horizon_days:
+        cutoff = int(time.time() - horizon_days * 86400)
+        cur.execute("""
+            SELECT sequence_id, frequency FROM user_sequences
+            WHERE user_id=? AND frequency<=? AND last_seen<?
+        """, (user_id, PRUNE_FREQUENCY, cutoff))
+        stale = dict(cur.fetchall())
+
+    over = {}
+    if max_sequences:
+        # the long tail past the top `max_sequences` by frequency, the
+        # most recently seen first among equals
         cur.execute("""
-            INSERT INTO user_sequences (user, sequence, frequency)
-            VALUES (?, ?, 1)
-            ON CONFLICT(user, sequence)
-            DO UPDATE SET frequency = frequency + 1
-        """, (user, seq))
+            SELECT sequence_id, frequency FROM user_sequences
+            WHERE user_id=?
+            ORDER BY frequency DESC, last_seen DESC
+            LIMIT -1 OFFSET ?
+        """, (user_id, max_sequences))
+        over = {k: f for k, f in cur.fetchall() if k not in stale}
+    return stale, over
+
+
+def compact_profile(user, max_sequences=None, horizon_days=None):
+    """
+    Bound a user's profile: delete sequences seen at most
+    PRUNE_FREQUENCY times and not within `horizon_days`, then the
+    long tail beyond the `max_sequences` most frequent. Their
+    observations are folded into the residual (see keep_residual), so
+    the weights of the kept sequences do not change.
+    Returns a CompactResult, or None if the user has no profile.
+    """
+    if max_sequences is None:
+        max_sequences = PROFILE_MAX_SEQUENCES
+    if horizon_days is None:
+        horizon_days = PROFILE_HORIZON_DAYS
 
+    start = time.perf_counter()
+    conn  = get_db()
+    cur   = conn.cursor()
+    try:
+        user_id = _user_id(cur, user)
+        if user_id is None:
+            return None
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT COUNT(*) FROM user_sequences WHERE user_id=?",
+                    (user_id,))
+        before = cur.fetchone()[0]
+
+        stale, over = _prune_candidates(cur, user_id, max_sequences,
+                                        horizon_days)
+        pruned = {**stale, **over}
+        if pruned:
+            moments = _load_moments(cur, user_id)
+            cur.executemany(
+                "DELETE FROM user_sequences WHERE user_id=? AND sequence_id=?",
+                [(user_id, k) for k in pruned]
+            )
+            for f in pruned.values():
+                moments.change(f, 0)
+            keep_residual(cur, user_id, moments, sum(pruned.values()))
+        conn.commit()
+    finally:
+        conn.close()
+
+    if pruned:
+        profile_cache.invalidate(user)
+    return CompactResult(before, before - len(pruned), len(stale), len(over),
+                         sum(pruned.values()), time.perf_counter() - start)
+
+
+def prune_vocab():
+    """Delete interned sequences no profile references; returns the count."""
+    conn = get_db()
+    cur  = conn.cursor()
+    cur.execute("""
+        DELETE FROM sequence_vocab
+        WHERE id NOT IN (SELECT sequence_id FROM user_sequences)
+    """)
+    removed = cur.rowcount
     conn.commit()
     conn.close()
-    return len(sequences)
+    return removed
+
+
+def profile_users():
+    """Names of every user with a profile, sorted."""
+    conn = get_db()
+    rows = conn.execute("SELECT name FROM profile_users ORDER BY name").fetchall()
+    conn.close()
+    return [r[0] for r in rows]
 
 
 def user_exists(user):
     """Check if a user has a trained profile."""
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT 1 FROM user_sequences WHERE user = ? LIMIT 1", (user,))
+    cur.execute("""
+        SELECT 1 FROM user_sequences s
+        JOIN profile_users u ON u.id = s.user_id
+        WHERE u.name = ? LIMIT 1
+    """, (user,))
     exists = cur.fetchone() is not None
     conn.close()
     return exists
@@ -46,9 +411,28 @@ def get_profile_stats(user):
             MAX(frequency)  as max_frequency,
             MIN(frequency)  as min_frequency,
             AVG(frequency)  as avg_frequency
-        FROM user_sequences
-        WHERE user = ?
+        FROM user_sequences s
+        JOIN profile_users u ON u.id = s.user_id
+        WHERE u.name = ?
     """, (user,))
     row = cur.fetchone()
     conn.close()
-    return dict(row) if row else {}
\ No newline at end of file
+    return dict(row) if row else {}
+
+
+def get_top_sequences(user, limit=50):
+    """Return a user's most frequent (sequence, frequency) rows."""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT v.text AS sequence, s.frequency
+        FROM user_sequences s
+        JOIN profile_users  u ON u.id = s.user_id
+        JOIN sequence_vocab v ON v.id = s.sequence_id
+        WHERE u.name = ?
+        ORDER BY s.frequency DESC
+        LIMIT ?
+    """, (user, limit))
+    rows = cur.fetchall()
+    conn.close()
+    return rows
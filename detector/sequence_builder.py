@@ -1,4 +1,14 @@
-def build_sequences(commands, window=3):
+import os
+from collections import Counter, deque
+
+from detector.ngram import SEP, seq_text
+
+# window length used for profiles and detection; the profile trie keeps
+# every shorter order as well (see ngram.py)
+NGRAM_ORDER = int(os.environ.get("CSIDS_NGRAM_ORDER", 3))
+
+
+def build_sequences(commands, window=NGRAM_ORDER):
     """
     Build sliding window sequences from a list of cleaned commands.
 
@@ -24,4 +34,66 @@ def build_sequences(commands, window=3):
 
 def build_bigrams(commands):
     """Build 2-command pairs — useful for fine-grained analysis."""
-    return build_sequences(commands, window=2)
\ No newline at end of file
+    return build_sequences(commands, window=2)
+
+
+def iter_sequences(commands, window=NGRAM_ORDER):
+    """
+    Streaming build_sequences() — consumes any iterable of cleaned
+    commands and yields the same sequences while holding only the
+    current window in memory.
+    """
+    buf = deque(maxlen=window)
+    emitted = False
+    for cmd in commands:
+        buf.append(cmd)
+        if len(buf) == window:
+            emitted = True
+            yield " | ".join(buf)
+
+    # fewer commands than the window — one short sequence, as above
+    if not emitted and buf:
+        yield " | ".join(buf)
+
+
+def iter_windows(commands, window=NGRAM_ORDER):
+    """
+    Lazy counterpart of iter_sequences(): yields each window of cleaned
+    commands as a tuple sharing the command strings instead of a newly
+    joined string. A tuple hashes in C and equals every other
+    occurrence of the same window, so windows can be counted and looked
+    up in profiles as they are; they are only joined to text
+    (ngram.seq_text) when stored or shown.
+
+    A window holding a command with a pipe in it is yielded as its
+    joined string: its stored text splits into more commands than the
+    window has, so a tuple would not match its profile row.
+    """
+    buf     = deque(maxlen=window)
+    clean   = window        # commands since the last one with a pipe
+    emitted = False
+    for cmd in commands:
+        buf.append(cmd)
+        clean = 0 if "|" in cmd else clean + 1
+        if len(buf) == window:
+            emitted = True
+            yield tuple(buf) if clean >= window else SEP.join(buf)
+
+    if not emitted and buf:
+        yield tuple(buf) if clean >= len(buf) else SEP.join(buf)
+
+
+def count_sequences(sequences):
+    """
+    {sequence text: count} of sequence strings or windows, joining
+    each distinct window once rather than every occurrence.
+    """
+    counts = Counter()
+    for seq, n in Counter(sequences).items():
+        counts[seq_text(seq)] += n
+    return counts
+
+
+def render_sequence(window):
+    """The sequence string of a window of CommandRecords."""
+    return SEP.join([rec.text for rec in window])
@@ -0,0 +1,259 @@
+"""
+Binary profile snapshots.
+
+A snapshot holds the compiled profiles (ngram.py tries plus their
+TF-IDF moments) of one or more users in a single file that loads
+without touching SQLite. Use one to warm another app node, to move a
+user between databases, or to serve detection straight from the file
+(CSIDS_SNAPSHOT=path) for users the database has no profile for.
+
+Layout, little-endian, every block 8-byte aligned:
+
+    header      b"CSIDSNP1", u32 version, u32 user count
+    directory   per user: u32 name length, name (utf-8),
+                u64 block offset, u64 block size
+    user block  i64 total, f64 sum_sq, f64 sum_sq_log, f64 sum_sq_log2
+                u64 commands, u64 nodes, u64 vocabulary bytes
+                vocabulary: the trie's commands, utf-8, "\\n"-separated
+                i64 arrays [nodes]: total, freq, parent, cmd, edge key
+
+The file is memory-mapped and only the requested users' blocks are
+read: each array is one memcpy into the trie, the vocabulary one
+decode and split, and the edge dict is rebuilt from the stored keys
+in a single dict(zip()).
+"""
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+
+from detector.ngram import NgramTrie, _NODE_OVERHEAD
+from detector.profile_cache import CompiledProfile
+from detector.tfidf import Moments
+
+MAGIC   = b"CSIDSNP1"
+VERSION = 1
+
+# serve detection from this snapshot for users not in SQLite (see get_profile)
+SNAPSHOT_PATH = os.environ.get("CSIDS_SNAPSHOT")
+
+_HEADER = struct.Struct("<8sII")
+_NAME   = struct.Struct("<I")
+_ENTRY  = struct.Struct("<QQ")
+_BLOCK  = struct.Struct("<qdddQQQ")
+
+# per-node arrays, in file order
+_ARRAYS = ("total", "freq", "parent", "cmd", "edge")
+
+# arrays are stored little-endian whatever the host
+_SWAP = sys.byteorder == "big"
+
+
+def _pad(n):
+    return -n % 8
+
+
+def _block(profile):
+    """Serialize one CompiledProfile into a user block."""
+    trie  = profile.freq
+    nodes = len(trie.total)
+    vocab = "\n".join(trie.cmds).encode("utf-8")
+
+    edge = array("q", bytes(8 * nodes))
+    for key, node in trie.edges.items():
+        edge[node] = key
+
+    parts = [_BLOCK.pack(*profile.moments.as_row(), len(trie.cmds), nodes,
+                         len(vocab)),
+             vocab, b"\0" * _pad(len(vocab))]
+    for name in _ARRAYS:
+        values = edge if name == "edge" else getattr(trie, name)
+        if _SWAP:
+            values = array("q", values)
+            values.byteswap()
+        parts.append(values.tobytes())
+    return b"".join(parts)
+
+
+def write_snapshot(path, profiles):
+    """Write {user: CompiledProfile} to `path` atomically."""
+    names  = [user.encode("utf-8") for user in profiles]
+    blocks = [_block(p) for p in profiles.values()]
+
+    directory = sum(_NAME.size + len(n) + _ENTRY.size for n in names)
+    offset    = _HEADER.size + directory
+    offset   += _pad(offset)
+
+    entries = []
+    for name, block in zip(names, blocks):
+        entries.append(_NAME.pack(len(name)) + name +
+                       _ENTRY.pack(offset, len(block)))
+        offset += len(block) + _pad(len(block))
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(names)))
+        f.write(b"".join(entries))
+        f.write(b"\0" * _pad(f.tell()))
+        for block in blocks:
+            f.write(block)
+            f.write(b"\0" * _pad(len(block)))
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    """A memory-mapped snapshot file; profile(user) loads one user."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a CSIDS profile snapshot")
+        if version != VERSION:
+            raise ValueError(f"{path}: unsupported snapshot version {version}")
+
+        self.blocks = {}
+        pos = _HEADER.size
+        for _ in range(count):
+            (length,) = _NAME.unpack_from(self._map, pos)
+            pos      += _NAME.size
+            user      = self._map[pos:pos + length].decode("utf-8")
+            pos      += length
+            self.blocks[user] = _ENTRY.unpack_from(self._map, pos)
+            pos      += _ENTRY.size
+
+    def users(self):
+        return list(self.blocks)
+
+    def __contains__(self, user):
+        return user in self.blocks
+
+    def profile(self, user):
+        """The user's CompiledProfile, or None if not in the snapshot."""
+        entry = self.blocks.get(user)
+        if entry is None:
+            return None
+        offset, _ = entry
+        view      = memoryview(self._map)
+
+        *row, n_cmds, nodes, vocab_len = _BLOCK.unpack_from(self._map, offset)
+        pos  = offset + _BLOCK.size
+        text = bytes(view[pos:pos + vocab_len]).decode("utf-8")
+        pos += vocab_len + _pad(vocab_len)
+
+        trie = NgramTrie()
+        trie.cmds = text.split("\n") if n_cmds else []
+        for name in _ARRAYS:
+            values = array("q")
+            values.frombytes(view[pos:pos + 8 * nodes])
+            if _SWAP:
+                values.byteswap()
+            pos += 8 * nodes
+            if name == "edge":
+                trie.edges = dict(zip(values[1:], range(1, nodes)))
+            else:
+                setattr(trie, name, values)
+        view.release()
+
+        trie.cmd_ids = {cmd: i for i, cmd in enumerate(trie.cmds)}
+        trie.size    = nodes - trie.freq.count(0)
+        trie.nbytes  = (sum(map(sys.getsizeof, trie.cmds)) +
+                        _NODE_OVERHEAD * (n_cmds + nodes - 1))
+        # the exported total also counts compacted-away observations
+        return CompiledProfile(trie, Moments(*row), row[0] - sum(trie.freq))
+
+    def close(self):
+        self._map.close()
+
+
+# ── database side ─────────────────────────────────────────────
+
+def export_profiles(path, users=None):
+    """Snapshot the trained profiles of `users` (default: everyone)."""
+    from detector.detector import get_trained_sequences
+    from detector.profiler import get_moments, get_residual, profile_users
+
+    profiles = {}
+    for user in users or profile_users():
+        trained = get_trained_sequences(user)
+        if trained:
+            profiles[user] = CompiledProfile(trained, get_moments(user),
+                                             get_residual(user))
+    write_snapshot(path, profiles)
+    return list(profiles)
+
+
+def import_profiles(path, users=None):
+    """
+    Replace the stored profiles of `users` (default: everyone in the
+    snapshot) with the snapshot's. Returns the users imported.
+    """
+    from database import get_db
+    from detector import profile_cache
+    from detector.profiler import (learn_sequences, keep_residual, _user_id,
+                                   write_lock)
+
+    snap = Snapshot(path)
+    conn = get_db()
+    cur  = conn.cursor()
+    done = []
+    try:
+        write_lock(cur)
+        for user in users or snap.users():
+            profile = snap.profile(user)
+            if profile is None:
+                print(f"[SNAPSHOT] {user}: not in {path}")
+                continue
+            user_id = _user_id(cur, user, create=True)
+            cur.execute("DELETE FROM user_sequences WHERE user_id=?", (user_id,))
+            cur.execute("DELETE FROM profile_stats  WHERE user_id=?", (user_id,))
+            moments = learn_sequences(cur, user, dict(profile.freq.items()))
+            # observations of sequences compacted away before export
+            if profile.total > moments.total:
+                keep_residual(cur, user_id, moments,
+                              profile.total - moments.total)
+            done.append(user)
+        conn.commit()
+    finally:
+        conn.close()
+        snap.close()
+    for user in done:
+        profile_cache.invalidate(user)
+    return done
+
+
+# ── serving from a snapshot ───────────────────────────────────
+
+_open     = {}      # path -> (Snapshot, (st_ino, st_mtime_ns))
+_open_lck = threading.Lock()
+
+
+def snapshot_profile(user, path=None):
+    """
+    The user's profile from the CSIDS_SNAPSHOT file (or `path`), or
+    None when no snapshot is configured, the file is missing or the
+    user is not in it.
+    """
+    path = path or SNAPSHOT_PATH
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        with _open_lck:
+            _open.pop(path, None)
+        return None
+    key = (st.st_ino, st.st_mtime_ns)
+    with _open_lck:
+        snap, opened = _open.get(path, (None, None))
+        if opened != key:
+            # rewritten (write_snapshot renames over it): map the new
+            # file; the old mapping goes when its last reader is done
+            snap = Snapshot(path)
+            _open[path] = snap, key
+    return snap.profile(user)
@@ -0,0 +1,154 @@
+"""
+NumPy batch scoring engine.
+
+Same contract and output as detector.detect_tfidf(), but sequences are
+interned to integer ids and both the profile and the incoming batch
+are handled as sparse vectors (id array + value array), so TF-IDF
+weights, the cosine similarity, the rarity check and thresholding are
+vectorized. Only interning and dangerous-pattern scanning still touch
+each distinct sequence in Python.
+
+Select it with CSIDS_ENGINE=sparse. numpy is optional: without it the
+detector falls back to the tfidf engine.
+"""
+try:
+    import numpy as np
+except ImportError:         # optional dependency
+    np = None
+
+SPARSE = "sparse"
+
+
+def available():
+    return np is not None
+
+
+class SparseProfile:
+    """A compiled profile as {sequence: id} plus a dense counts array."""
+
+    def __init__(self, freq):
+        self.vocab  = {seq: i for i, seq in enumerate(freq)}
+        self.counts = np.fromiter(freq.values(), dtype=np.float64,
+                                  count=len(freq))
+        self.size   = len(freq)
+
+    def apply(self, counts):
+        """Follow an in-place profile update (see CompiledProfile.apply)."""
+        for seq, delta in counts.items():
+            idx = self.vocab.get(seq)
+            if idx is None:
+                if self.size == len(self.counts):
+                    # amortized growth, like list.append
+                    grown = np.zeros(max(16, 2 * self.size), dtype=np.float64)
+                    grown[:self.size] = self.counts[:self.size]
+                    self.counts = grown
+                idx = self.vocab[seq] = self.size
+                self.size += 1
+            self.counts[idx] += delta
+
+
+def tfidf_weights(freq, total):
+    """Vectorized tfidf.weight(); zero where freq is zero."""
+    if total <= 0:
+        return np.zeros_like(freq)
+    w = (freq / total) * (np.log((total + 1) / (freq + 1)) + 1)
+    return np.where(freq > 0, w, 0.0)
+
+
+def _sparse_profile(profile):
+    form = profile.derived.get(SPARSE)
+    if form is None:
+        form = profile.derived[SPARSE] = SparseProfile(profile.freq)
+    return form
+
+
+def detect_sparse(profile, new_sequences):
+    """Score a batch of sequences against a compiled profile."""
+    # local import — detector imports this module lazily
+    from detector.detector import (scan_sequence, score_sequence,
+                                   make_alert, unseen_penalty)
+    from detector.ngram import seq_text
+
+    sp    = _sparse_profile(profile)
+    total = profile.total
+
+    # intern the batch: codes[i] is the local id of new_sequences[i]
+    local = {}
+    codes = np.fromiter((local.setdefault(seq, len(local))
+                         for seq in new_sequences),
+                        dtype=np.int64, count=len(new_sequences))
+    distinct  = list(local)
+    new_count = np.bincount(codes, minlength=len(distinct)).astype(np.float64)
+
+    # map local ids to profile ids (-1 = never seen)
+    pid   = np.fromiter((sp.vocab.get(seq_text(seq), -1) for seq in distinct),
+                        dtype=np.int64, count=len(distinct))
+    known = pid >= 0
+    freq  = np.zeros(len(distinct), dtype=np.float64)
+    freq[known] = sp.counts[pid[known]]
+
+    # cosine similarity against the profile's maintained norm
+    new_w = tfidf_weights(new_count, float(len(new_sequences)))
+    dot   = float(np.dot(tfidf_weights(freq, total), new_w))
+    mag1  = profile.norm()
+    mag2  = float(np.linalg.norm(new_w))
+    similarity      = dot / (mag1 * mag2) if mag1 and mag2 else 0.0
+    overall_anomaly = 1.0 - similarity
+
+    # Factor 1: unseen (with n-gram back-off) / rare
+    unseen = np.fromiter((0.0 if k else unseen_penalty(profile, seq)[0]
+                          for seq, k in zip(distinct, known)),
+                         dtype=np.float64, count=len(distinct))
+    score  = np.where(known,
+                      np.where(freq / max(total, 1) < 0.01, 1.5, 0.0),
+                      unseen)
+
+    # Factor 2: overall behavior similarity
+    if overall_anomaly > 0.7:
+        score = score + 2.0
+    elif overall_anomaly > 0.4:
+        score = score + 1.0
+
+    # Factor 3: dangerous patterns
+    matches = [scan_sequence(seq) for seq in distinct]
+    score   = score + np.fromiter(
+        (sum(p for _, p, _ in m.patterns) for m in matches),
+        dtype=np.float64, count=len(distinct))
+
+    score    = np.minimum(score, 10.0)
+    alerting = np.flatnonzero(score >= 6.0)
+    if not len(alerting):
+        return []
+
+    # reasons are only rendered for the sequences that alert
+    scored = {}
+    for i in alerting:
+        seq = distinct[i]
+        seq_anomaly, reasons, risky = score_sequence(
+            seq, profile, overall_anomaly, matches[i])
+        scored[i] = make_alert(seq, seq_anomaly, reasons, risky)
+
+    hit = np.zeros(len(distinct), dtype=bool)
+    hit[alerting] = True
+    return [dict(scored[codes[i]]) for i in np.flatnonzero(hit[codes])]
+
+
+def check_parity(user, new_sequences):
+    """
+    Run both engines on the same batch and return a list of
+    (index, tfidf_alert, sparse_alert) differences; empty means parity.
+    """
+    from detector.detector import detect
+
+    expected, err1 = detect(user, new_sequences, engine="tfidf")
+    actual,   err2 = detect(user, new_sequences, engine=SPARSE)
+    if err1 or err2:
+        return [(None, err1, err2)] if err1 != err2 else []
+
+    diffs = []
+    for i in range(max(len(expected), len(actual))):
+        a = expected[i] if i < len(expected) else None
+        b = actual[i] if i < len(actual) else None
+        if a != b:
+            diffs.append((i, a, b))
+    return diffs
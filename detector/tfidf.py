@@ -0,0 +1,122 @@
+"""
+Incremental TF-IDF bookkeeping.
+
+detect() weights a sequence with frequency f in a profile of total T as
+
+    w(f, T) = (f / T) * (log((T + 1) / (f + 1)) + 1)
+
+Writing a = log(T + 1) + 1 and g = log(f + 1), the squared norm of the
+whole vector is
+
+    |w|^2 = (a^2 * S2 - 2a * S2g + S2gg) / T^2
+
+where S2 = sum(f^2), S2g = sum(f^2 g) and S2gg = sum(f^2 g^2). Those
+three sums and T only change by the terms of the sequences whose
+frequency changed, so the norm can be kept up to date in O(1) per
+upsert instead of being rebuilt from the full profile.
+"""
+import math
+
+
+def weight(freq, total):
+    """TF-IDF weight of one sequence — same formula as build_tfidf_profile."""
+    if total <= 0 or freq <= 0:
+        return 0.0
+    return (freq / total) * (math.log((total + 1) / (freq + 1)) + 1)
+
+
+class Moments:
+    """Running aggregates from which a TF-IDF norm is derived."""
+
+    __slots__ = ("total", "sum_sq", "sum_sq_log", "sum_sq_log2")
+
+    def __init__(self, total=0, sum_sq=0.0, sum_sq_log=0.0, sum_sq_log2=0.0):
+        self.total       = total
+        self.sum_sq      = sum_sq
+        self.sum_sq_log  = sum_sq_log
+        self.sum_sq_log2 = sum_sq_log2
+
+    @classmethod
+    def from_counts(cls, counts):
+        """Build aggregates from a full {sequence: frequency} map."""
+        m = cls()
+        for f in counts.values():
+            m.change(0, f)
+        return m
+
+    def change(self, old, new):
+        """Account for one sequence moving from frequency `old` to `new`."""
+        self.total += new - old
+        for f, sign in ((old, -1), (new, 1)):
+            if f <= 0:
+                continue
+            f2 = f * f
+            g  = math.log(f + 1)
+            self.sum_sq      += sign * f2
+            self.sum_sq_log  += sign * f2 * g
+            self.sum_sq_log2 += sign * f2 * g * g
+
+    def norm(self):
+        """Magnitude of the TF-IDF vector these aggregates describe."""
+        if self.total <= 0:
+            return 0.0
+        a  = math.log(self.total + 1) + 1
+        n2 = (a * a * self.sum_sq
+              - 2 * a * self.sum_sq_log
+              + self.sum_sq_log2) / (self.total * self.total)
+        # guard against tiny negative values from float cancellation
+        return math.sqrt(max(n2, 0.0))
+
+    def as_row(self):
+        return (self.total, self.sum_sq, self.sum_sq_log, self.sum_sq_log2)
+
+
+class RunningSimilarity:
+    """
+    Cosine similarity between a fixed profile and a growing stream of
+    sequences, updated in O(1) per sequence.
+
+    With c_s the stream count of s, n the stream length and p_s the
+    profile weight, the dot product is
+
+        (a_n * sum(p_s c_s) - sum(p_s c_s log(c_s + 1))) / n
+
+    so only those two sums, the stream's Moments and c_s are kept.
+    Counts are keyed by hash and capped at `max_tracked` distinct
+    sequences; beyond that new sequences are counted as one-offs, which
+    keeps memory constant however long the stream is.
+    """
+
+    def __init__(self, profile, max_tracked=1_000_000):
+        self.freq          = profile.freq
+        self.profile_total = profile.total
+        self.profile_norm  = profile.norm()
+        self.max_tracked   = max_tracked
+        self.counts        = {}
+        self.moments       = Moments()
+        self.dot_a         = 0.0
+        self.dot_b         = 0.0
+
+    def add(self, seq):
+        key = hash(seq)
+        old = self.counts.get(key, 0)
+        new = old + 1
+        if old or len(self.counts) < self.max_tracked:
+            self.counts[key] = new
+        self.moments.change(old, new)
+
+        p = weight(self.freq.get(seq, 0), self.profile_total)
+        if p:
+            self.dot_a += p
+            self.dot_b += p * (new * math.log(new + 1) - old * math.log(old + 1))
+
+    def similarity(self):
+        n = self.moments.total
+        if n <= 0 or self.profile_norm == 0:
+            return 0.0
+        mag2 = self.moments.norm()
+        if mag2 == 0:
+            return 0.0
+        a   = math.log(n + 1) + 1
+        dot = (a * self.dot_a - self.dot_b) / n
+        return dot / (self.profile_norm * mag2)
@@ -0,0 +1,297 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and latency histograms live in a module-level registry
+and are rendered by render() for the Flask /metrics endpoint, or
+written to a file / served on a port by long-running processes such as
+monitor.py.
+
+Stage timings are exclusive: when one timed stage runs inside another
+(e.g. clean_commands pulling lines from upload_parse), the inner
+stage's time is subtracted from the outer one, so the per-stage
+histograms add up to where the time actually went.
+"""
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_lock       = threading.Lock()
+_registry   = {}
+_collectors = []
+_local      = threading.local()
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\")
+                      .replace("\n", "\\n")
+                      .replace('"', '\\"'))
+
+
+def _fmt_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name   = name
+        self.help   = help_text
+        self.values = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def _samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_fmt_labels(key, extra)} {_fmt_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Mirror a running total kept elsewhere (see collector())."""
+        with _lock:
+            self.values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the exclusive time of a block (usable as a decorator)."""
+        stack = _stage_stack()
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested  = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.observe(elapsed - nested, **labels)
+
+    def _samples(self):
+        for key, (counts, total, count) in self.values.items():
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                yield (f"{self.name}_bucket", key,
+                       (("le", _fmt_value(bound)),), running)
+            yield f"{self.name}_sum", key, (), total
+            yield f"{self.name}_count", key, (), count
+
+
+def _get(cls, name, help_text, **kwargs):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help_text, **kwargs)
+        return metric
+
+
+def counter(name, help_text):
+    return _get(Counter, name, help_text)
+
+
+def gauge(name, help_text):
+    return _get(Gauge, name, help_text)
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return _get(Histogram, name, help_text, buckets=buckets)
+
+
+def collector(fn):
+    """Register fn() to refresh gauges just before each render."""
+    _collectors.append(fn)
+    return fn
+
+
+def render():
+    """All metrics in the Prometheus text format."""
+    for fn in _collectors:
+        try:
+            fn()
+        except Exception as e:
+            print(f"[METRICS] collector {fn.__name__} failed: {e}")
+    with _lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+        lines   = []
+        for m in metrics:
+            lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ── shared metrics ────────────────────────────────────────────
+
+STAGE_SECONDS = histogram(
+    "csids_stage_seconds",
+    "Time spent in each pipeline stage, excluding nested stages.")
+SQLITE_SECONDS = histogram(
+    "csids_sqlite_query_seconds",
+    "SQLite statement execution time by statement type.")
+DETECTIONS = counter(
+    "csids_detections_total", "Detection runs per user.")
+ALERTS = counter(
+    "csids_alerts_total", "Alerts raised per user.")
+
+
+def _stage_stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def timed_iter(iterable, stage):
+    """
+    Pass `iterable` through, observing the time spent producing its
+    items as one STAGE_SECONDS sample once it is exhausted or closed.
+    """
+    stack = _stage_stack()
+    own   = 0.0
+    it    = iter(iterable)
+    try:
+        while True:
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                nested  = stack.pop()
+                own    += elapsed - nested
+                if stack:
+                    stack[-1] += elapsed
+            yield item
+    finally:
+        STAGE_SECONDS.observe(own, stage=stage)
+
+
+# ── SQLite timing ─────────────────────────────────────────────
+
+@lru_cache(maxsize=1024)
+def _statement_kind(sql):
+    word = sql.lstrip().split(None, 1)
+    return word[0].lower() if word else "empty"
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            SQLITE_SECONDS.observe(time.perf_counter() - start,
+                                   op=_statement_kind(sql))
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            SQLITE_SECONDS.observe(time.perf_counter() - start,
+                                   op=_statement_kind(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3.connect(..., factory=TimedConnection) times every statement."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+# ── export for processes without Flask ────────────────────────
+
+def write_file(path):
+    """Atomically write the current metrics to `path`."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """Serve /metrics on a background thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
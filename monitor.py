@@ -2,63 +2,82 @@ import time
 import os
 import sys
 import argparse
-import sqlite3
+import signal
+from collections import Counter, deque
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "ids.db")
 sys.path.insert(0, os.path.dirname(__file__))
 
-from detector.preprocess       import clean_commands
-from detector.sequence_builder import build_sequences
-from detector.profiler         import train_user
+import metrics
+import offsets
+from database                  import get_db, init_db
+from retention                 import command_count
+from watcher                   import FileWatcher
+from detector.preprocess       import normalize_command, parse_command
+from detector.sequence_builder import render_sequence, NGRAM_ORDER
+from detector                  import profile_cache
+from detector.profiler         import learn_sequences, compact_profile
 from detector.detector         import detect
 
 BASELINE_THRESHOLD = 100
 
+# seconds between compactions of the continuously learned profile
+COMPACT_INTERVAL = 3600
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# longest wait for the history file to change before periodic work
+# (compaction, metrics file) gets a chance to run
+IDLE_TIMEOUT = 60
+
+# live_log rows, alerts and profile updates are buffered and written in
+# one transaction once this many commands are pending or the oldest has
+# waited FLUSH_INTERVAL seconds (and always on shutdown)
+FLUSH_ROWS     = 500
+FLUSH_INTERVAL = 1.0
+
+COMMANDS = metrics.counter(
+    "csids_monitor_commands_total", "Commands seen by the live monitor.")
 
 
 def get_total_commands(user):
-    conn = get_db()
-    cur  = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM live_log WHERE user=?", (user,))
-    count = cur.fetchone()[0]
-    conn.close()
-    return count
+    # raw rows plus the rolled-up counts of expired ones
+    return command_count(user)
 
 
-def log_command(user, cmd, risk_score=0.0, flagged=0):
-    try:
-        conn = get_db()
-        conn.execute(
-            "INSERT INTO live_log "
-            "(user,command,risk_score,flagged) VALUES (?,?,?,?)",
-            (user, cmd, risk_score, flagged)
-        )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"[DB ERROR log] {e}")
+def timestamp():
+    """Now, in the UTC "YYYY-MM-DD HH:MM:SS" form of CURRENT_TIMESTAMP."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
 
 
-def save_alert(user, sequence, reason, risk_score, risky_cmds):
+def write_pending(user, logs, alerts, learned, path=None, checkpoint=None):
+    """
+    Write buffered live_log rows, alerts and {sequence: delta} profile
+    updates for `user` in one transaction, together with the read
+    offsets.Checkpoint of `path` they were read up to.
+    """
+    conn = get_db()
+    cur  = conn.cursor()
     try:
-        conn = get_db()
-        conn.execute(
+        cur.execute("BEGIN IMMEDIATE")
+        cur.executemany(
+            "INSERT INTO live_log "
+            "(user,command,risk_score,flagged,timestamp) VALUES (?,?,?,?,?)",
+            [(user,) + row for row in logs]
+        )
+        cur.executemany(
             "INSERT INTO alerts "
-            "(user,sequence,reason,risk_score,risky_cmds) "
-            "VALUES (?,?,?,?,?)",
-            (user, sequence, reason, risk_score, ','.join(risky_cmds))
+            "(user,sequence,reason,risk_score,risky_cmds,timestamp) "
+            "VALUES (?,?,?,?,?,?)",
+            [(user,) + row for row in alerts]
         )
+        if learned:
+            learn_sequences(cur, user, learned)
+        if checkpoint is not None:
+            offsets.save(cur, user, path, checkpoint)
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
-        return True
-    except Exception as e:
-        print(f"[DB ERROR alert] {e}")
-        return False
 
 
 def get_user_email(user):
@@ -110,36 +129,293 @@ def send_auto_alert(user, alerts):
         traceback.print_exc()
 
 
-def build_seqs(commands):
+def build_seqs(records):
+    """The sequence of a full window of CommandRecords."""
     try:
-        cleaned   = clean_commands([c + '\n' for c in commands])
-        sequences = build_sequences(cleaned)
-        return sequences
+        return [render_sequence(records)]
     except Exception as e:
         print(f"[SEQ ERROR] {e}")
         return []
 
 
-def update_profile(user, sequences):
+def compact(user):
+    """Keep the learned profile within its size budget."""
     try:
-        if sequences:
-            train_user(user, sequences)
+        result = compact_profile(user)
+        if result and result.after < result.before:
+            print(f"[PROFILE] Compacted {user}: {result.before} → "
+                  f"{result.after} sequences in {result.seconds:.2f}s")
     except Exception as e:
         print(f"[PROFILE ERROR] {e}")
 
 
 def run_detection(user, sequences):
+    """The alerts for `sequences`, or None if detection could not run."""
     try:
         alerts, error = detect(user, sequences)
         if error:
-            return []
+            print(f"[DETECT ERROR] {error}")
+            return None
         return alerts if alerts else []
     except Exception as e:
         print(f"[DETECT ERROR] {e}")
-        return []
+        return None
 
 
-def monitor(user, history_path):
+class UserMonitor:
+    """
+    One user's live state: the read offset into their history file
+    (checkpointed in the database, see offsets.py), the sliding window
+    of parsed commands, the command count and when the profile was
+    last compacted. monitor() drives one of these; daemon.py drives
+    many.
+
+    Database writes are buffered (see FLUSH_ROWS): call flush() before
+    letting go of a UserMonitor. Learned sequences reach this process's
+    profile cache at once, so detection does not wait for the flush;
+    the baseline itself is flushed as soon as it is complete.
+    """
+
+    def __init__(self, user, history_path, quiet=False):
+        self.user         = user
+        self.path         = os.path.abspath(history_path)
+        self.quiet        = quiet
+        # sliding window of the last NGRAM_ORDER commands, parsed once
+        self.buffer       = deque(maxlen=NGRAM_ORDER)
+        self.commands     = 0
+        self.last_compact = None
+        # commands ever logged for the user, counted here from now on
+        self.total        = get_total_commands(user)
+
+        # pending writes: live_log rows, alert rows, profile deltas
+        self.logs          = []
+        self.alerts        = []
+        self.learned       = Counter()
+        self.pending_since = None
+        # high-risk alerts to email once their rows are committed
+        self.notify        = []
+        # the cached profile that holds every pending delta, if any
+        self.synced        = None
+
+        # resume after the last command recorded for this file; a file
+        # never seen before is read from its end, from now on
+        checkpoint = offsets.load(user, self.path)
+        if checkpoint is None:
+            checkpoint = offsets.at_end(self.path)
+            write_pending(user, [], [], None, self.path, checkpoint)
+        self.last_pos, self.tail, how = offsets.locate(self.path, checkpoint)
+        if how:
+            print(f"[WATCH] {self.path} was {how} while not monitored; "
+                  f"reading on from byte {self.last_pos}")
+        st               = os.stat(self.path)
+        self.inode       = st.st_ino
+        self.size        = st.st_size
+        self.catching_up = self.size > self.last_pos
+        if self.catching_up:
+            print(f"[CSIDS] {user}: catching up on {self.size - self.last_pos} "
+                  f"bytes of history written since the last run")
+
+    def say(self, text):
+        if not self.quiet and not self.catching_up:
+            print(text)
+
+    def checkpoint(self):
+        """The offsets.Checkpoint of everything processed so far."""
+        return offsets.Checkpoint(self.inode, self.size, self.last_pos, self.tail)
+
+    def _read_from(self, pos):
+        with open(self.path, 'rb') as f:
+            st         = os.fstat(f.fileno())
+            self.inode = st.st_ino
+            self.size  = st.st_size
+            f.seek(pos)
+            return f.read()
+
+    def read_new(self):
+        """
+        Complete lines (bytes) appended to the history file since the
+        last processed one. If the file was truncated or rewritten in
+        the meantime, first finds where reading should go on.
+        """
+        data = self._read_from(self.last_pos - len(self.tail))
+        if not data.startswith(self.tail):
+            pos, tail, how = offsets.locate(self.path, self.checkpoint())
+            print(f"[WATCH] {self.path} was {how}; reading on from byte {pos}")
+            self.last_pos, self.tail = pos, tail
+            data = self._read_from(pos - len(tail))
+        data = data[len(self.tail):]
+        # a line still being written is left for the next call
+        return data[:data.rfind(b"\n") + 1].splitlines(keepends=True)
+
+    def poll(self):
+        """
+        Process every new command, then flush if due; returns how many
+        commands there were.
+        """
+        seen  = 0
+        start = time.perf_counter()
+        for raw_line in self.read_new():
+            self.last_pos += len(raw_line)
+            self.tail      = (self.tail + raw_line)[-offsets.TAIL_BYTES:]
+            cmd = raw_line.decode('utf-8', 'replace').strip()
+            if not cmd or cmd.startswith('#'):
+                continue
+            self.process(cmd)
+            seen += 1
+            if len(self.logs) >= FLUSH_ROWS:
+                self.flush()
+        self.commands += seen
+
+        if self.catching_up:
+            self.catching_up = False
+            self.flush()
+            print(f"[CSIDS] {self.user}: caught up on {seen} commands in "
+                  f"{time.perf_counter() - start:.2f}s")
+        if self.flush_in() == 0:
+            self.flush()
+        if (self.last_compact is None or
+                time.monotonic() - self.last_compact >= COMPACT_INTERVAL):
+            # compaction works on the table: write everything first
+            if self.flush():
+                compact(self.user)
+                self.last_compact = time.monotonic()
+        return seen
+
+    def flush_in(self):
+        """Seconds until pending writes are due (0 = now), None if none."""
+        if self.pending_since is None:
+            return None
+        return max(self.pending_since + FLUSH_INTERVAL - time.monotonic(), 0)
+
+    def flush(self):
+        """
+        Write everything pending in one transaction, then email the
+        high-risk alerts it committed; True on success.
+        """
+        if self.pending_since is None:
+            return True
+        try:
+            write_pending(self.user, self.logs, self.alerts, self.learned,
+                          self.path, self.checkpoint())
+        except Exception as e:
+            # keep the rows and retry after another FLUSH_INTERVAL
+            print(f"[DB ERROR flush] {self.user}: {e}")
+            self.pending_since = time.monotonic()
+            return False
+        self.logs          = []
+        self.alerts        = []
+        if self.notify:
+            notify, self.notify = self.notify, []
+            send_auto_alert(self.user, notify)
+        if self.synced is None or profile_cache.peek(self.user) is not self.synced:
+            # the cache missed some deltas (not cached, or reloaded from
+            # the table before they were written): reload with them
+            profile_cache.invalidate(self.user)
+        self.learned       = Counter()
+        self.pending_since = None
+        self.synced        = None
+        return True
+
+    def _pending(self):
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+
+    def learn(self, seqs):
+        counts = Counter(seqs)
+        first  = not self.learned
+        self.learned.update(counts)
+        self._pending()
+        # keep this process's cached profile in step before the flush
+        profile = profile_cache.update(self.user, counts)
+        if first:
+            self.synced = profile
+        elif profile is not self.synced:
+            self.synced = None
+
+    def process(self, cmd):
+        user  = self.user
+        total = self.total
+        self.total += 1
+        self.logs.append((cmd, 0.0, 0, timestamp()))
+        self._pending()
+        COMMANDS.inc(user=user)
+
+        self.buffer.append(parse_command(normalize_command(cmd)))
+
+        # ── BASELINE TRAINING ─────────────────────────────────
+        if total < BASELINE_THRESHOLD:
+            self.say(f"🔵 [TRAIN {total+1}/{BASELINE_THRESHOLD}]"
+                     f" [{user}] {cmd}")
+
+            if len(self.buffer) == NGRAM_ORDER:
+                seqs = build_seqs(self.buffer)
+                if seqs:
+                    self.learn(seqs)
+
+            if total + 1 >= BASELINE_THRESHOLD:
+                # detection needs the baseline in the database: an
+                # uncached profile is not built from pending deltas
+                self.flush()
+                profile_cache.invalidate(user)
+                print(f"\n{'='*60}")
+                print(f"[CSIDS] ✅ BASELINE TRAINING COMPLETE! [{user}]")
+                print(f"[CSIDS]    Detection mode activated.")
+                print(f"[CSIDS]    Profile keeps learning continuously.")
+                print(f"[CSIDS]    Alerts based on sequence of {NGRAM_ORDER} commands.")
+                print(f"{'='*60}\n")
+            return
+
+        # ── DETECTION + CONTINUOUS LEARNING ───────────────────
+        self.say(f"⌨  [DETECT] [{user}] {cmd}")
+        if len(self.buffer) < NGRAM_ORDER:
+            return
+
+        seqs = build_seqs(self.buffer)
+        self.say(f"   🔍 Analyzing: {seqs[0] if seqs else ''}")
+        if not seqs:
+            return
+
+        alerts = run_detection(user, seqs)
+        if alerts is None:
+            # no verdict, so nothing to learn either
+            return
+        if not alerts:
+            # safe — update profile continuously
+            self.learn(seqs)
+            self.say(f"   ✅ Safe sequence — profile updated")
+            return
+
+        for a in alerts:
+            self.alerts.append((
+                a['sequence'],
+                a['reason'],
+                a['risk_score'],
+                ','.join(a['risky']),
+                timestamp()
+            ))
+            print(f"\n{'='*60}")
+            print(f"   ⚠  INTRUSION ALERT!")
+            print(f"   User      : {user}")
+            print(f"   Sequence  : {a['sequence']}")
+            print(f"   Reason    : {a['reason']}")
+            print(f"   Risk Score: {a['risk_score']:.1f}")
+            print(f"{'='*60}\n")
+
+        high_risk = [a for a in alerts if a['risk_score'] >= 6.0]
+        if high_risk:
+            # the email links to the alert: commit it first
+            self.notify.extend(high_risk)
+            self.flush()
+
+
+def permission_help(user, history_path):
+    print(f"[ERROR] Permission denied.")
+    print(f"[FIX]   sudo /home/vboxuser/csids/venv/bin/python "
+          f"/home/vboxuser/csids/monitor.py "
+          f"--user {user} --history {history_path}")
+
+
+def monitor(user, history_path, metrics_file=None, quiet=False):
     history_path = os.path.expanduser(history_path)
     history_path = os.path.abspath(history_path)
 
@@ -148,9 +424,17 @@ def monitor(user, history_path):
     print(f"[CSIDS] Baseline threshold  : {BASELINE_THRESHOLD} commands")
     print(f"[CSIDS] Technique           : N-gram + TF-IDF + Cosine Similarity")
     print(f"[CSIDS] Profile update      : Continuous learning")
-    print(f"[CSIDS] Alert basis         : Sequence of 3 commands")
+    print(f"[CSIDS] Alert basis         : Sequence of {NGRAM_ORDER} commands")
     print(f"[CSIDS] Press Ctrl+C to stop.\n")
 
+    # the monitor uses tables of the latest schema (read_offsets,
+    # live_log rollups): upgrade the database if the app has not yet
+    try:
+        init_db()
+    except Exception as e:
+        print(f"[ERROR] Database: {e}")
+        sys.exit(1)
+
     # wait for file
     waited = 0
     while not os.path.exists(history_path):
@@ -163,8 +447,17 @@ def monitor(user, history_path):
             print("[ERROR] File not found after 60s.")
             sys.exit(1)
 
+    try:
+        session = UserMonitor(user, history_path, quiet)
+    except PermissionError:
+        permission_help(user, history_path)
+        sys.exit(1)
+    except Exception as e:
+        print(f"[ERROR] Cannot start monitoring {history_path}: {e}")
+        sys.exit(1)
+
     # show status
-    total = get_total_commands(user)
+    total = session.total
     if total < BASELINE_THRESHOLD:
         remaining = BASELINE_THRESHOLD - total
         print(f"[CSIDS] 🔵 BASELINE TRAINING MODE")
@@ -174,102 +467,31 @@ def monitor(user, history_path):
         print(f"[CSIDS] ✅ DETECTION + CONTINUOUS LEARNING MODE")
         print(f"[CSIDS]    {total} commands in profile\n")
 
-    # seek to end
-    with open(history_path, 'r', errors='replace') as f:
-        f.seek(0, 2)
-        last_pos = f.tell()
+    # wakes on changes to the file only (inotify, else stat polling)
+    watcher = FileWatcher(history_path)
+    print(f"[CSIDS] File watching       : {watcher.mode}\n")
 
-    # sliding window of last 3 commands
-    command_buffer = []
+    # stop on SIGTERM (systemd, kill) as on Ctrl+C, so pending writes
+    # are flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     while True:
         try:
-            with open(history_path, 'r', errors='replace') as f:
-                f.seek(last_pos)
-                lines    = f.readlines()
-                last_pos = f.tell()
-
-            for raw_line in lines:
-                cmd = raw_line.strip()
-                if not cmd or cmd.startswith('#'):
-                    continue
-
-                total = get_total_commands(user)
-                log_command(user, cmd, 0.0, 0)
-
-                command_buffer.append(cmd)
-                if len(command_buffer) > 3:
-                    command_buffer.pop(0)
-
-                # ── BASELINE TRAINING ─────────────────────────────────
-                if total < BASELINE_THRESHOLD:
-                    print(f"🔵 [TRAIN {total+1}/{BASELINE_THRESHOLD}]"
-                          f" [{user}] {cmd}")
-
-                    if len(command_buffer) == 3:
-                        seqs = build_seqs(command_buffer)
-                        if seqs:
-                            update_profile(user, seqs)
-
-                    if total + 1 >= BASELINE_THRESHOLD:
-                        print(f"\n{'='*60}")
-                        print(f"[CSIDS] ✅ BASELINE TRAINING COMPLETE!")
-                        print(f"[CSIDS]    Detection mode activated.")
-                        print(f"[CSIDS]    Profile keeps learning continuously.")
-                        print(f"[CSIDS]    Alerts based on sequence of 3 commands.")
-                        print(f"{'='*60}\n")
-
-                # ── DETECTION + CONTINUOUS LEARNING ───────────────────
-                else:
-                    print(f"⌨  [DETECT] [{user}] {cmd}")
-
-                    if len(command_buffer) == 3:
-                        seqs    = build_seqs(command_buffer)
-                        seq_str = ' | '.join(command_buffer)
-                        print(f"   🔍 Analyzing: {seq_str}")
-
-                        if seqs:
-                            alerts = run_detection(user, seqs)
-
-                            if alerts:
-                                for a in alerts:
-                                    saved = save_alert(
-                                        user,
-                                        a['sequence'],
-                                        a['reason'],
-                                        a['risk_score'],
-                                        a['risky']
-                                    )
-                                    if saved:
-                                        print(f"\n{'='*60}")
-                                        print(f"   ⚠  INTRUSION ALERT!")
-                                        print(f"   Sequence  : {a['sequence']}")
-                                        print(f"   Reason    : {a['reason']}")
-                                        print(f"   Risk Score: {a['risk_score']:.1f}")
-                                        print(f"{'='*60}\n")
-
-                                high_risk = [
-                                    a for a in alerts
-                                    if a['risk_score'] >= 6.0
-                                ]
-                                if high_risk:
-                                    send_auto_alert(user, high_risk)
-                            else:
-                                # safe — update profile continuously
-                                update_profile(user, seqs)
-                                print(f"   ✅ Safe sequence — profile updated")
-
-            time.sleep(1)
+            session.poll()
+            if metrics_file:
+                metrics.write_file(metrics_file)
+            due = session.flush_in()
+            watcher.wait(IDLE_TIMEOUT if due is None else min(due, IDLE_TIMEOUT))
 
         except PermissionError:
-            print(f"[ERROR] Permission denied.")
-            print(f"[FIX]   sudo /home/vboxuser/csids/venv/bin/python "
-                  f"/home/vboxuser/csids/monitor.py "
-                  f"--user {user} --history {history_path}")
+            session.flush()
+            permission_help(user, history_path)
             sys.exit(1)
 
         except KeyboardInterrupt:
+            session.flush()
             print("\n[CSIDS] Monitor stopped.")
+            watcher.close()
             break
 
         except Exception as e:
@@ -279,8 +501,38 @@ def monitor(user, history_path):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='CSIDS Live Monitor')
-    parser.add_argument('--user',    required=True)
+    parser.add_argument('--user')
     parser.add_argument('--history',
                         default=os.path.expanduser('~/.bash_history'))
+    parser.add_argument('--quiet', action='store_true',
+                        help='print alerts only, not every command')
+    parser.add_argument('--config',
+                        help='daemon mode: file of "user history-path" lines')
+    parser.add_argument('--discover', nargs='?', const='/home/*/.bash_history',
+                        metavar='GLOB',
+                        help='daemon mode: watch every matching history '
+                             '(default /home/*/.bash_history), user = home dir')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='daemon mode: detection threads')
+    parser.add_argument('--status-interval', type=float, default=60,
+                        help='daemon mode: seconds between per-user lag reports')
+    parser.add_argument('--metrics-file',
+                        help='rewrite Prometheus metrics to this file as commands arrive')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics on this local port')
     args = parser.parse_args()
-    monitor(args.user, args.history)
\ No newline at end of file
+    if not (args.user or args.config or args.discover):
+        parser.error('--user, --config or --discover is required')
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f"[CSIDS] Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    if args.config or args.discover:
+        import daemon
+        targets = daemon.read_config(args.config) if args.config else []
+        if args.user:
+            targets.append((args.user, os.path.expanduser(args.history)))
+        daemon.run(targets, args.workers, args.discover,
+                   args.status_interval, args.metrics_file)
+    else:
+        monitor(args.user, args.history, args.metrics_file, args.quiet)
@@ -5,6 +5,10 @@ from email.mime.text      import MIMEText
 from email.mime.base      import MIMEBase
 from email                import encoders
 
+import metrics
+
+EMAILS = metrics.counter("csids_emails_total", "Alert emails by outcome.")
+
 
 def send_alert_email(to_email, username, alerts):
     smtp_host = os.environ.get("CSIDS_SMTP_HOST", "smtp.gmail.com")
@@ -14,6 +18,7 @@ def send_alert_email(to_email, username, alerts):
 
     if not smtp_user or not smtp_pass:
         print("[NOTIFIER] SMTP not configured — skipping email")
+        EMAILS.inc(result="skipped")
         return False
 
     high   = [a for a in alerts if (a.get('risk_score') or 0) >= 6]
@@ -145,13 +150,16 @@ def send_alert_email(to_email, username, alerts):
 
     # send email
     try:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
+        with metrics.STAGE_SECONDS.time(stage="smtp_send"), \
+                smtplib.SMTP(smtp_host, smtp_port) as server:
             server.ehlo()
             server.starttls()
             server.login(smtp_user, smtp_pass)
             server.sendmail(smtp_user, to_email, msg.as_string())
         print(f"[NOTIFIER] ✅ Email sent to {to_email}")
+        EMAILS.inc(result="sent")
         return True
     except Exception as e:
         print(f"[NOTIFIER] ❌ Email failed: {e}")
+        EMAILS.inc(result="failed")
         return False
\ No newline at end of file
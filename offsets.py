@@ -0,0 +1,101 @@
+"""
+Checkpointed read offsets into history files.
+
+The monitor stores how far it has read each (user, history file) in
+read_offsets, in the same transaction as the rows it wrote for those
+commands, so a restart resumes exactly after the last command recorded
+and commands typed while it was down are still analyzed.
+
+A checkpoint is the offset plus a fingerprint of the file: its inode,
+its size and the last TAIL_BYTES bytes before the offset. The tail
+tells whether the offset still points where it did. Bash rewrites the
+file when it trims it to HISTFILESIZE, sometimes in place and
+sometimes by renaming a new file over it, which moves every line
+towards the start. locate() finds the tail again in the new content and
+resumes right after it. If the tail is gone (the file was emptied,
+truncated past it or replaced by an unrelated file), reading restarts
+at the beginning, because all of that content is new.
+"""
+import os
+from collections import namedtuple
+
+from database import get_db
+
+TAIL_BYTES = 64     # bytes before the offset kept as its fingerprint
+
+Checkpoint = namedtuple("Checkpoint", ["inode", "size", "offset", "tail"])
+
+
+def load(user, path):
+    """The stored Checkpoint for `user`'s `path`, or None."""
+    conn = get_db()
+    cur  = conn.cursor()
+    cur.execute("""
+        SELECT inode, size, offset, tail FROM read_offsets
+        WHERE user=? AND path=?
+    """, (user, path))
+    row = cur.fetchone()
+    conn.close()
+    return Checkpoint(row[0], row[1], row[2], bytes(row[3])) if row else None
+
+
+def save(cur, user, path, checkpoint):
+    """Store a Checkpoint on an open cursor. Does not commit."""
+    cur.execute("""
+        INSERT INTO read_offsets (user, path, inode, size, offset, tail, updated)
+        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(user, path) DO UPDATE SET
+            inode   = excluded.inode,
+            size    = excluded.size,
+            offset  = excluded.offset,
+            tail    = excluded.tail,
+            updated = excluded.updated
+    """, (user, path) + tuple(checkpoint))
+
+
+def at_end(path):
+    """A Checkpoint at the current end of `path`."""
+    with open(path, "rb") as f:
+        st  = os.fstat(f.fileno())
+        end = st.st_size
+        f.seek(max(end - TAIL_BYTES, 0))
+        tail = f.read(end - f.tell())
+    return Checkpoint(st.st_ino, end, end, tail)
+
+
+def locate(path, checkpoint):
+    """
+    Where to resume reading `path` as it is now: (offset, tail, how).
+    `how` is None when the checkpoint still holds; otherwise it is
+    "truncated", "rewritten" or "replaced", to describe what happened.
+    """
+    offset, tail = checkpoint.offset, checkpoint.tail
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size >= offset:
+            f.seek(offset - len(tail))
+            if f.read(len(tail)) == tail:
+                return offset, tail, None
+        f.seek(0)
+        data = f.read()
+
+    if st.st_ino != checkpoint.inode:
+        how = "replaced"
+    elif st.st_size < offset:
+        how = "truncated"
+    else:
+        how = "rewritten"
+
+    # lines only ever move towards the start: the tail's new place
+    # is the last one ending at or before the old offset
+    found = data.rfind(tail, 0, offset) if tail else -1
+    if found >= 0:
+        return found + len(tail), tail, how
+
+    # trimmed to less than the tail: the file starts with its last lines
+    start = tail.find(b"\n") + 1
+    while 0 < start < len(tail):
+        if data.startswith(tail[start:]):
+            return len(tail) - start, tail[start:], how
+        start = tail.find(b"\n", start) + 1
+    return 0, b"", how
@@ -13,6 +13,8 @@ from reportlab.lib.enums import TA_CENTER
 from datetime import datetime
 import io
 
+import metrics
+
 # colors
 BG_BLUE  = HexColor("#0f3460")
 ACCENT   = HexColor("#00d4ff")
@@ -32,6 +34,7 @@ def risk_color(score):
     return GREEN
 
 
+@metrics.STAGE_SECONDS.time(stage="pdf_render")
 def generate_pdf_report(user, alerts, stats=None):
     """
     Generate a styled PDF report.
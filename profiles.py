@@ -0,0 +1,96 @@
+"""
+CSIDS profile maintenance — export trained profiles to a binary
+snapshot and load them into another database or node, or compact them.
+
+    python profiles.py export all.snap              # every user
+    python profiles.py export alice.snap --user alice
+    python profiles.py import alice.snap            # replaces alice's profile
+    python profiles.py list all.snap
+    python profiles.py compact --max-sequences 50000 --horizon-days 30
+
+A node can also detect straight from a snapshot, without importing
+it: start it with CSIDS_SNAPSHOT=all.snap and profiles of users in the
+file are loaded from it (see detector/snapshot.py).
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database          import init_db
+from detector.profiler import (compact_profile, prune_vocab, profile_users,
+                               PROFILE_MAX_SEQUENCES, PROFILE_HORIZON_DAYS)
+from detector.snapshot import Snapshot, export_profiles, import_profiles
+
+
+def show(path):
+    snap = Snapshot(path)
+    print(f"{'user':<16} {'sequences':>10} {'windows':>10} {'nodes':>9}")
+    for user in snap.users():
+        p = snap.profile(user)
+        print(f"{user:<16} {len(p.freq):>10} {p.total:>10} "
+              f"{len(p.freq.total):>9}")
+    snap.close()
+
+
+def compact(users, max_sequences, horizon_days):
+    """Compact each user's profile and print before/after row counts."""
+    start = time.perf_counter()
+    print(f"{'user':<16} {'before':>9} {'after':>9} {'stale':>8} "
+          f"{'budget':>8} {'residual':>9} {'secs':>7}")
+    before = after = 0
+    for user in users or profile_users():
+        r = compact_profile(user, max_sequences, horizon_days)
+        if r is None:
+            print(f"[ERROR] {user}: no trained profile")
+            continue
+        before, after = before + r.before, after + r.after
+        print(f"{user:<16} {r.before:>9} {r.after:>9} {r.stale:>8} "
+              f"{r.over_budget:>8} {r.residual:>9} {r.seconds:>7.2f}")
+    vocab = prune_vocab()
+    print(f"[PROFILE] {before} → {after} sequences, {vocab} unused "
+          f"vocabulary rows removed in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSIDS Profile Maintenance")
+    parser.add_argument("action", choices=["export", "import", "list",
+                                           "compact"])
+    parser.add_argument("path", nargs="?", help="snapshot file")
+    parser.add_argument("--user", action="append",
+                        help="only this user (repeatable; default: all)")
+    parser.add_argument("--max-sequences", type=int,
+                        default=PROFILE_MAX_SEQUENCES,
+                        help="compact: sequences kept per user (0 = no limit)")
+    parser.add_argument("--horizon-days", type=float,
+                        default=PROFILE_HORIZON_DAYS,
+                        help="compact: prune one-off sequences not seen for "
+                             "this many days (0 = never)")
+    args = parser.parse_args()
+    if args.action == "compact":
+        init_db()
+        compact(args.user, args.max_sequences, args.horizon_days)
+        sys.exit(0)
+    if not args.path:
+        parser.error(f"{args.action} needs a snapshot path")
+
+    start = time.perf_counter()
+    try:
+        if args.action == "list":
+            show(args.path)
+            sys.exit(0)
+        init_db()
+        if args.action == "export":
+            users = export_profiles(args.path, args.user)
+        else:
+            users = import_profiles(args.path, args.user)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+
+    size = os.path.getsize(args.path)
+    print(f"[SNAPSHOT] {args.action}ed {len(users)} profiles "
+          f"({size / 1024:.0f} KiB) in {time.perf_counter() - start:.2f}s: "
+          f"{', '.join(users) or '-'}")
@@ -0,0 +1,328 @@
+"""
+CSIDS live_log retention — roll raw command rows up into per-user
+hourly and daily aggregates and drop raw rows past a configurable age.
+
+    python retention.py              # one pass
+    python retention.py --loop       # every CSIDS_RETENTION_INTERVAL seconds
+
+app.py runs the same pass on a background thread. Work is done in
+batches of BATCH_ROWS rows, each in its own short transaction, so the
+monitor's inserts and the live feed never wait long for it.
+
+Every live_log row is rolled up exactly once: the rollup and the
+job_state watermark (the last rolled-up id) move in one transaction.
+Only rows at or below the watermark are ever deleted, so nothing is
+lost from the aggregates. Counts for a user are therefore
+
+    rollups (ids <= watermark) + raw rows (ids > watermark)
+
+which is what command_count(), hourly_activity() and daily_activity()
+return.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database
+from database import get_db
+
+# raw live_log rows older than this are deleted (0 = keep forever)
+RETENTION_DAYS        = float(os.environ.get("CSIDS_LIVE_LOG_RETENTION_DAYS", "30"))
+# hourly rollups older than this are deleted; daily ones are kept
+HOURLY_RETENTION_DAYS = float(os.environ.get("CSIDS_HOURLY_RETENTION_DAYS", "90"))
+# copy raw rows here (an SQLite file) before deleting them
+ARCHIVE_PATH          = os.environ.get("CSIDS_LIVE_LOG_ARCHIVE")
+# seconds between background passes (0 = no background thread)
+INTERVAL              = float(os.environ.get("CSIDS_RETENTION_INTERVAL", "300"))
+
+BATCH_ROWS  = 1000      # live_log rows rolled up or deleted per transaction
+BATCH_PAUSE = 0.05      # seconds between batches, to let writers in
+
+WATERMARK = "live_log_rolled_up"
+
+# live_log.timestamp is "YYYY-MM-DD HH:MM:SS" (UTC, CURRENT_TIMESTAMP)
+_BUCKETS = (("live_log_hourly", "hour", "substr(timestamp, 1, 13) || ':00:00'"),
+            ("live_log_daily",  "day",  "substr(timestamp, 1, 10)"))
+
+
+def _cutoff(days):
+    """live_log timestamp of `days` days ago."""
+    then = datetime.now(timezone.utc) - timedelta(days=days)
+    return then.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def watermark(cur):
+    cur.execute("SELECT value FROM job_state WHERE name=?", (WATERMARK,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+# ── rollup ────────────────────────────────────────────────────
+
+def _rollup_batch(conn):
+    """Roll up the next BATCH_ROWS rows; returns how many were rolled."""
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        low = watermark(cur)
+        cur.execute("""
+            SELECT COUNT(*), MAX(id) FROM (
+                SELECT id FROM live_log WHERE id>? ORDER BY id LIMIT ?
+            )
+        """, (low, BATCH_ROWS))
+        rows, high = cur.fetchone()
+        if not rows:
+            conn.rollback()
+            return 0
+
+        for table, bucket, expr in _BUCKETS:
+            cur.execute(f"""
+                INSERT INTO {table}
+                    (user, {bucket}, commands, flagged, risky, max_risk, sum_risk)
+                SELECT user, {expr}, COUNT(*),
+                       SUM(flagged != 0),
+                       SUM(COALESCE(risk_score, 0) >= 3),
+                       MAX(COALESCE(risk_score, 0)),
+                       SUM(COALESCE(risk_score, 0))
+                FROM live_log WHERE id>? AND id<=?
+                GROUP BY 1, 2
+                ON CONFLICT(user, {bucket}) DO UPDATE SET
+                    commands = commands + excluded.commands,
+                    flagged  = flagged  + excluded.flagged,
+                    risky    = risky    + excluded.risky,
+                    max_risk = MAX(max_risk, excluded.max_risk),
+                    sum_risk = sum_risk + excluded.sum_risk
+            """, (low, high))
+
+        cur.execute("""
+            INSERT INTO job_state (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value
+        """, (WATERMARK, high))
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# ── expiry ────────────────────────────────────────────────────
+
+def _open_archive(path):
+    archive = sqlite3.connect(path, timeout=database.BUSY_TIMEOUT)
+    archive.execute("""
+        CREATE TABLE IF NOT EXISTS live_log (
+            id         INTEGER PRIMARY KEY,
+            user       TEXT NOT NULL,
+            command    TEXT NOT NULL,
+            risk_score REAL,
+            flagged    INTEGER,
+            timestamp  TIMESTAMP
+        )
+    """)
+    return archive
+
+
+def _expire_batch(conn, cutoff, archive=None):
+    """
+    Delete up to BATCH_ROWS rolled-up rows older than `cutoff`, copying
+    them to `archive` first. Returns how many were deleted.
+    """
+    cur = conn.cursor()
+    # rolled-up rows never change, so they can be read (and archived)
+    # before the write lock is taken
+    # by age, not by the first ids: an old row behind newer ones with
+    # lower ids (a clock change, a late insert) must still expire
+    cur.execute("""
+        SELECT id, user, command, risk_score, flagged, timestamp
+        FROM live_log
+        WHERE id<=? AND timestamp<?
+        ORDER BY id LIMIT ?
+    """, (watermark(cur), cutoff, BATCH_ROWS))
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+    if archive is not None:
+        # committed before the delete: a crash in between only means
+        # the same rows are copied (and ignored) next pass
+        archive.executemany(
+            "INSERT OR IGNORE INTO live_log VALUES (?,?,?,?,?,?)",
+            [tuple(r) for r in rows])
+        archive.commit()
+
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.executemany("DELETE FROM live_log WHERE id=?",
+                        [(r[0],) for r in rows])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def run_once(retention_days=None, archive_path=None):
+    """
+    One retention pass: roll up everything new, then expire old raw
+    rows and hourly rollups. Returns {"rolled", "expired", "hourly",
+    "seconds"}.
+    """
+    if retention_days is None:
+        retention_days = RETENTION_DAYS
+    archive_path = archive_path or ARCHIVE_PATH
+
+    start  = time.perf_counter()
+    conn   = get_db()
+    result = {"rolled": 0, "expired": 0, "hourly": 0}
+    archive = None
+    try:
+        while True:
+            rolled = _rollup_batch(conn)
+            result["rolled"] += rolled
+            if rolled < BATCH_ROWS:
+                break
+            time.sleep(BATCH_PAUSE)
+
+        if retention_days:
+            cutoff  = _cutoff(retention_days)
+            archive = _open_archive(archive_path) if archive_path else None
+            while True:
+                expired = _expire_batch(conn, cutoff, archive)
+                result["expired"] += expired
+                if not expired:
+                    break
+                time.sleep(BATCH_PAUSE)
+
+        if HOURLY_RETENTION_DAYS:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM live_log_hourly WHERE hour<?",
+                        (_cutoff(HOURLY_RETENTION_DAYS)[:13] + ":00:00",))
+            result["hourly"] = cur.rowcount
+            conn.commit()
+    finally:
+        conn.close()
+        if archive is not None:
+            archive.close()
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _loop(interval):
+    while True:
+        try:
+            r = run_once()
+            if r["rolled"] or r["expired"]:
+                print(f"[RETENTION] rolled up {r['rolled']}, expired "
+                      f"{r['expired']} live_log rows in {r['seconds']:.2f}s")
+        except Exception as e:
+            print(f"[RETENTION] pass failed: {e}")
+        time.sleep(interval)
+
+
+def start(interval=None):
+    """Run retention passes on a daemon thread; returns it (or None)."""
+    interval = INTERVAL if interval is None else interval
+    if not interval:
+        return None
+    thread = threading.Thread(target=_loop, args=(interval,),
+                              name="csids-retention", daemon=True)
+    thread.start()
+    return thread
+
+
+# ── reads that span raw rows and rollups ──────────────────────
+
+def command_count(user):
+    """Commands ever logged for `user`, including expired ones."""
+    conn = get_db()
+    cur  = conn.cursor()
+    mark = watermark(cur)
+    cur.execute("SELECT COALESCE(SUM(commands), 0) FROM live_log_daily "
+                "WHERE user=?", (user,))
+    rolled = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM live_log WHERE user=? AND id>?",
+                (user, mark))
+    count = rolled + cur.fetchone()[0]
+    conn.close()
+    return count
+
+
+def _activity(user, buckets, since):
+    """
+    Command counts per bucket (one of _BUCKETS) from `since` on, newest
+    first: rollups for what has been rolled up, raw rows for the rest.
+    Each row also says whether that bucket's raw commands are still kept.
+    """
+    table, bucket, expr = buckets
+    conn  = get_db()
+    cur   = conn.cursor()
+    mark  = watermark(cur)
+
+    activity = {}
+    cur.execute(f"""
+        SELECT {bucket}, commands, flagged, risky, max_risk
+        FROM {table} WHERE user=? AND {bucket}>=?
+    """, (user, since))
+    queries = [cur.fetchall()]
+    cur.execute(f"""
+        SELECT {expr} AS b, COUNT(*),
+               SUM(flagged != 0), SUM(COALESCE(risk_score, 0) >= 3),
+               MAX(COALESCE(risk_score, 0))
+        FROM live_log WHERE user=? AND id>? GROUP BY b
+    """, (user, mark))
+    queries.append([r for r in cur.fetchall() if r[0] >= since])
+    for rows in queries:
+        for key, commands, flagged, risky, max_risk in rows:
+            a = activity.setdefault(key, {bucket: key, "commands": 0,
+                                          "flagged": 0, "risky": 0,
+                                          "max_risk": 0.0})
+            a["commands"] += commands
+            a["flagged"]  += flagged
+            a["risky"]    += risky
+            a["max_risk"]  = max(a["max_risk"], max_risk)
+
+    cur.execute(f"""
+        SELECT {expr} FROM live_log
+        WHERE id=(SELECT MIN(id) FROM live_log WHERE user=?)
+    """, (user,))
+    row    = cur.fetchone()
+    oldest = row[0] if row else None
+    conn.close()
+
+    for a in activity.values():
+        a["raw"] = oldest is not None and a[bucket] >= oldest
+    return sorted(activity.values(), key=lambda a: a[bucket], reverse=True)
+
+
+def hourly_activity(user, hours=48):
+    """Per-hour command counts for the last `hours` hours (see _activity)."""
+    return _activity(user, _BUCKETS[0], _cutoff(hours / 24)[:13] + ":00:00")
+
+
+def daily_activity(user, days=30):
+    """Per-day command counts for the last `days` days (see _activity)."""
+    return _activity(user, _BUCKETS[1], _cutoff(days)[:10])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSIDS live_log Retention")
+    parser.add_argument("--days", type=float, default=RETENTION_DAYS,
+                        help="delete raw rows older than this (0 = never)")
+    parser.add_argument("--archive", default=ARCHIVE_PATH,
+                        help="copy deleted rows to this SQLite file")
+    parser.add_argument("--loop", action="store_true",
+                        help=f"repeat every {INTERVAL:g}s")
+    args = parser.parse_args()
+
+    database.init_db()
+    if args.loop:
+        RETENTION_DAYS, ARCHIVE_PATH = args.days, args.archive
+        _loop(INTERVAL or 300)
+    r = run_once(args.days, args.archive)
+    print(f"[RETENTION] rolled up {r['rolled']}, expired {r['expired']} "
+          f"live_log rows, {r['hourly']} hourly rollups in {r['seconds']:.2f}s")
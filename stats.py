@@ -0,0 +1,99 @@
+"""
+Dashboard statistics read from materialized counters.
+
+alert_stats holds alert counts per (user, hour of day, risk level) and
+is kept up to date by triggers on alerts (see database.py, schema v5),
+so per-user totals, the hourly histogram and the risk buckets are sums
+over at most users × 24 × 3 rows however many alerts there are. The
+"last 24 hours" counts and recent alerts use the alerts(timestamp) and
+alerts(user, timestamp) indexes and only touch the newest rows.
+"""
+from database import get_db, backfill_alert_stats
+
+
+def _levels(rows):
+    return {r["level"]: r["cnt"] for r in rows if r["cnt"]}
+
+
+def profiled_users(cur):
+    """Users with at least one trained sequence — one index probe each."""
+    cur.execute("""
+        SELECT COUNT(*) FROM profile_users u
+        WHERE EXISTS (SELECT 1 FROM user_sequences s WHERE s.user_id = u.id)
+    """)
+    return cur.fetchone()[0]
+
+
+def dashboard_stats(top=5):
+    """Totals, top users, hourly histogram and risk buckets for all users."""
+    conn = get_db()
+    cur  = conn.cursor()
+    total_users = profiled_users(cur)
+
+    cur.execute("""
+        SELECT user, SUM(alerts) AS cnt FROM alert_stats
+        GROUP BY user HAVING cnt > 0 ORDER BY cnt DESC
+    """)
+    per_user = cur.fetchall()
+
+    cur.execute("""
+        SELECT hour, SUM(alerts) AS cnt FROM alert_stats GROUP BY hour
+    """)
+    hourly = [0] * 24
+    for row in cur.fetchall():
+        hourly[row["hour"]] = row["cnt"]
+
+    cur.execute("""
+        SELECT level, SUM(alerts) AS cnt FROM alert_stats GROUP BY level
+    """)
+    risk_dist = _levels(cur.fetchall())
+
+    cur.execute(
+        "SELECT COUNT(*) FROM alerts "
+        "WHERE timestamp > datetime('now', '-1 day')"
+    )
+    alerts_24h = cur.fetchone()[0]
+    conn.close()
+
+    return {
+        "total_users":  total_users,
+        "total_alerts": sum(r["cnt"] for r in per_user),
+        "alerts_24h":   alerts_24h,
+        "top_users":    per_user[:top],
+        "hourly":       hourly,
+        "risk_dist":    risk_dist,
+    }
+
+
+def user_stats(user):
+    """Alert totals and risk buckets for one user."""
+    conn = get_db()
+    cur  = conn.cursor()
+    cur.execute("""
+        SELECT level, SUM(alerts) AS cnt FROM alert_stats
+        WHERE user=? GROUP BY level
+    """, (user,))
+    risk_dist = _levels(cur.fetchall())
+    cur.execute(
+        "SELECT COUNT(*) FROM alerts "
+        "WHERE user=? AND timestamp > datetime('now','-1 day')",
+        (user,)
+    )
+    alerts_24h = cur.fetchone()[0]
+    conn.close()
+
+    return {
+        "total_alerts": sum(risk_dist.values()),
+        "alerts_24h":   alerts_24h,
+        "risk_dist":    risk_dist,
+    }
+
+
+def rebuild():
+    """Recompute alert_stats from scratch (e.g. after editing alerts by hand)."""
+    conn = get_db()
+    cur  = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    backfill_alert_stats(cur)
+    conn.commit()
+    conn.close()
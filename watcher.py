@@ -0,0 +1,173 @@
+"""
+Wait for a history file to change.
+
+On Linux, FileWatcher uses inotify (through ctypes, no extra packages)
+on the file's directory, so it wakes only for modify, truncate, move
+and create events of that one file name — including bash replacing
+the file when it trims it to HISTFILESIZE — and sleeps without any
+wakeups in between. Elsewhere, or when inotify is unavailable (e.g.
+fs.inotify.max_user_watches reached), it falls back to polling
+os.stat() every POLL_INTERVAL seconds.
+
+    watcher = FileWatcher(path)
+    while True:
+        if watcher.wait(timeout=60):
+            ...read the new lines...
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+POLL_INTERVAL = 1.0     # seconds between stat() calls without inotify
+
+# <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004     # truncate() changes size/mtime
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct("iIII")      # wd, mask, cookie, name length
+
+_libc = None
+
+
+def _inotify():
+    """libc with the inotify calls, or None where there is none."""
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+            _libc = libc
+        except (OSError, AttributeError, TypeError):
+            _libc = False
+    return _libc or None
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class FileWatcher:
+    """Wakes up when `path` changes; see the module docstring."""
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL):
+        self.path          = os.path.abspath(path)
+        self.directory     = os.path.dirname(self.path)
+        self.name          = os.fsencode(os.path.basename(self.path))
+        self.poll_interval = poll_interval
+        self.fd            = None
+        self._last         = _signature(self.path)
+        self._start_inotify()
+
+    @property
+    def mode(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    def _start_inotify(self):
+        libc = _inotify()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+        wd = libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            print(f"[WATCH] inotify unavailable ({os.strerror(err)}), "
+                  f"polling every {self.poll_interval:g}s")
+            return
+        self.fd = fd
+
+    def fileno(self):
+        """The inotify descriptor (for select / asyncio), or None."""
+        return self.fd
+
+    def read_events(self):
+        """
+        Drain pending inotify events without blocking; True if any was
+        about the watched file. Always True when polling and the file's
+        inode, size or mtime changed.
+        """
+        if self.fd is None:
+            now        = _signature(self.path)
+            changed    = now != self._last
+            self._last = now
+            return changed
+
+        relevant = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return relevant
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            pos = 0
+            while pos < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, pos)
+                pos  += _EVENT.size
+                name  = data[pos:pos + length].rstrip(b"\0")
+                pos  += length
+                if mask & IN_Q_OVERFLOW or name == self.name:
+                    relevant = True
+                elif mask & IN_IGNORED:
+                    # the directory itself went away — fall back to polling
+                    self.close()
+                    return True
+
+    def wait(self, timeout=None):
+        """
+        Block until the file changes or `timeout` seconds pass; returns
+        True if it (may have) changed.
+        """
+        if self.fd is None:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                if self.read_events():
+                    return True
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                time.sleep(self.poll_interval if left is None
+                           else min(self.poll_interval, left))
+
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not poller.poll(None if left is None else left * 1000):
+                return False
+            if self.read_events():
+                return True
+            if left == 0:
+                return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None